@@ -20,6 +20,7 @@ class Encoder(nn.Module):
     self.kernel_size = kernel_size
     self.p_dropout = p_dropout
     self.window_size = window_size
+    self.checkpointing = None # None, "layer" or "block", see SynthesizerTrn.set_gradient_checkpointing
 
     self.drop = nn.Dropout(p_dropout)
     self.attn_layers = nn.ModuleList()
@@ -33,19 +34,31 @@ class Encoder(nn.Module):
       self.norm_layers_2.append(LayerNorm(hidden_channels))
 
   def forward(self, x, x_mask):
+    if self.checkpointing == "block":
+      return commons.checkpoint(self._forward, x, x_mask)
+    return self._forward(x, x_mask)
+
+  def _forward(self, x, x_mask):
     attn_mask = x_mask.unsqueeze(2) * x_mask.unsqueeze(-1)
     x = x * x_mask
     for i in range(self.n_layers):
-      y = self.attn_layers[i](x, x, attn_mask)
-      y = self.drop(y)
-      x = self.norm_layers_1[i](x + y)
-
-      y = self.ffn_layers[i](x, x_mask)
-      y = self.drop(y)
-      x = self.norm_layers_2[i](x + y)
+      if self.checkpointing == "layer":
+        x = commons.checkpoint(self._layer, i, x, x_mask, attn_mask)
+      else:
+        x = self._layer(i, x, x_mask, attn_mask)
     x = x * x_mask
     return x
 
+  def _layer(self, i, x, x_mask, attn_mask):
+    y = self.attn_layers[i](x, x, attn_mask)
+    y = self.drop(y)
+    x = self.norm_layers_1[i](x + y)
+
+    y = self.ffn_layers[i](x, x_mask)
+    y = self.drop(y)
+    x = self.norm_layers_2[i](x + y)
+    return x
+
 
 class Decoder(nn.Module):
   def __init__(self, hidden_channels, filter_channels, n_heads, n_layers, kernel_size=1, p_dropout=0., proximal_bias=False, proximal_init=True, **kwargs):
@@ -140,7 +153,10 @@ class MultiHeadAttention(nn.Module):
     k = self.conv_k(c)
     v = self.conv_v(c)
     
-    x, self.attn = self.attention(q, k, v, mask=attn_mask)
+    x, attn = self.attention(q, k, v, mask=attn_mask)
+    # kept for inspection at inference only: in training it would hold every layer's attention
+    # map past the step, also when activation checkpointing should have freed it
+    self.attn = None if torch.is_grad_enabled() else attn
 
     x = self.conv_o(x)
     return x
@@ -152,13 +168,14 @@ class MultiHeadAttention(nn.Module):
     key = key.view(b, self.n_heads, self.k_channels, t_s).transpose(2, 3)
     value = value.view(b, self.n_heads, self.k_channels, t_s).transpose(2, 3)
 
-    scores = torch.matmul(query / math.sqrt(self.k_channels), key.transpose(-2, -1))
+    query = query / math.sqrt(self.k_channels)
+    scores = torch.matmul(query, key.transpose(-2, -1))
     if self.window_size is not None:
       assert t_s == t_t, "Relative attention is only available for self-attention."
-      key_relative_embeddings = self._get_relative_embeddings(self.emb_rel_k, t_s)
-      rel_logits = self._matmul_with_relative_keys(query /math.sqrt(self.k_channels), key_relative_embeddings)
-      scores_local = self._relative_position_to_absolute_position(rel_logits)
-      scores = scores + scores_local
+      # only the 2 * window_size + 1 positions around the diagonal have embeddings, so the
+      # relative terms are computed on that band instead of on all 2 * t - 1 positions
+      rel_logits = self._matmul_with_relative_keys(query, self.emb_rel_k)
+      scores = scores + self._band_to_absolute_position(rel_logits)
     if self.proximal_bias:
       assert t_s == t_t, "Proximal bias is only available for self-attention."
       scores = scores + self._attention_bias_proximal(t_s).to(device=scores.device, dtype=scores.dtype)
@@ -172,9 +189,8 @@ class MultiHeadAttention(nn.Module):
     p_attn = self.drop(p_attn)
     output = torch.matmul(p_attn, value)
     if self.window_size is not None:
-      relative_weights = self._absolute_position_to_relative_position(p_attn)
-      value_relative_embeddings = self._get_relative_embeddings(self.emb_rel_v, t_s)
-      output = output + self._matmul_with_relative_values(relative_weights, value_relative_embeddings)
+      relative_weights = self._absolute_position_to_band(p_attn)
+      output = output + self._matmul_with_relative_values(relative_weights, self.emb_rel_v)
     output = output.transpose(2, 3).contiguous().view(b, d, t_t) # [b, n_h, t_t, d_k] -> [b, d, t_t]
     return output, p_attn
 
@@ -196,50 +212,30 @@ class MultiHeadAttention(nn.Module):
     ret = torch.matmul(x, y.unsqueeze(0).transpose(-2, -1))
     return ret
 
-  def _get_relative_embeddings(self, relative_embeddings, length):
-    max_relative_position = 2 * self.window_size + 1
-    # Pad first before slice to avoid using cond ops.
-    pad_length = max(length - (self.window_size + 1), 0)
-    slice_start_position = max((self.window_size + 1) - length, 0)
-    slice_end_position = slice_start_position + 2 * length - 1
-    if pad_length > 0:
-      padded_relative_embeddings = F.pad(
-          relative_embeddings,
-          commons.convert_pad_shape([[0, 0], [pad_length, pad_length], [0, 0]]))
-    else:
-      padded_relative_embeddings = relative_embeddings
-    used_relative_embeddings = padded_relative_embeddings[:,slice_start_position:slice_end_position]
-    return used_relative_embeddings
-
-  def _relative_position_to_absolute_position(self, x):
+  def _band_to_absolute_position(self, x):
     """
-    x: [b, h, l, 2*l-1]
-    ret: [b, h, l, l]
+    x: [b, h, l, 2*w+1], relative positions -w..w
+    ret: [b, h, l, l], zero outside the band
     """
-    batch, heads, length, _ = x.size()
-    # Concat columns of pad to shift from relative to absolute indexing.
-    x = F.pad(x, commons.convert_pad_shape([[0,0],[0,0],[0,0],[0,1]]))
-
-    # Concat extra elements so to add up to shape (len+1, 2*len-1).
-    x_flat = x.view([batch, heads, length * 2 * length])
-    x_flat = F.pad(x_flat, commons.convert_pad_shape([[0,0],[0,0],[0,length-1]]))
-
-    # Reshape and slice out the padded elements.
-    x_final = x_flat.view([batch, heads, length+1, 2*length-1])[:, :, :length, length-1:]
+    batch, heads, length, width = x.size()
+    # Rows of length + 2*w + 1 read back as rows of length + 2*w shift each row one column right.
+    x = F.pad(x, commons.convert_pad_shape([[0, 0], [0, 0], [0, 0], [0, length]]))
+    x_flat = x.view([batch, heads, length * (length + width)])[:, :, :length * (length + width - 1)]
+    x_final = x_flat.view([batch, heads, length, length + width - 1])[:, :, :, self.window_size:self.window_size + length]
     return x_final
 
-  def _absolute_position_to_relative_position(self, x):
+  def _absolute_position_to_band(self, x):
     """
     x: [b, h, l, l]
-    ret: [b, h, l, 2*l-1]
+    ret: [b, h, l, 2*w+1], relative positions -w..w (zero past the sequence ends)
     """
     batch, heads, length, _ = x.size()
-    # padd along column
-    x = F.pad(x, commons.convert_pad_shape([[0, 0], [0, 0], [0, 0], [0, length-1]]))
-    x_flat = x.view([batch, heads, length**2 + length*(length -1)])
-    # add 0's in the beginning that will skew the elements after reshape
-    x_flat = F.pad(x_flat, commons.convert_pad_shape([[0, 0], [0, 0], [length, 0]]))
-    x_final = x_flat.view([batch, heads, length, 2*length])[:,:,:,1:]
+    width = 2 * self.window_size + 1
+    # Inverse of the above: pad w columns per side and read rows of length + 2*w as rows of length + 2*w + 1.
+    x = F.pad(x, commons.convert_pad_shape([[0, 0], [0, 0], [0, 0], [self.window_size, self.window_size]]))
+    x_flat = x.view([batch, heads, length * (length + width - 1)])
+    x_flat = F.pad(x_flat, commons.convert_pad_shape([[0, 0], [0, 0], [0, length]]))
+    x_final = x_flat.view([batch, heads, length, length + width])[:, :, :, :width]
     return x_final
 
   def _attention_bias_proximal(self, length):
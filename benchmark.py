@@ -0,0 +1,743 @@
+"""Microbenchmarks for the training hot path.
+
+Usage:
+  python benchmark.py collate --batch_size 64 --max_len 800
+  python benchmark.py manifest --rows 1000000
+  python benchmark.py wav --files 64 --seconds 8
+  python benchmark.py subband -c configs/ljs_mb_istft_vits.json
+  python benchmark.py mel -c configs/ljs_mb_istft_vits.json
+  python benchmark.py disc --batch_size 16 --segment_size 8192
+  python benchmark.py gradnorm -c configs/ljs_mb_istft_vits.json
+  python benchmark.py slice --batch_sizes 1 16 64
+  python benchmark.py mas --shapes 16x100x400 64x400x800
+  python benchmark.py negcent --batch_size 64 --t_text 400 --t_frames 800
+  python benchmark.py checkpointing --batch_size 16 --t_text 200 --t_frames 800
+  python benchmark.py compile -c configs/ljs_mb_istft_vits.json --batch_size 16
+  python benchmark.py attention --batch_size 16 --lengths 50 200 600
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import tempfile
+import time
+import numpy as np
+import torch
+
+
+def timeit(fn, iters=10, warmup=2):
+  """Average wall time of `fn()` in seconds."""
+  for _ in range(warmup):
+    fn()
+  start = time.perf_counter()
+  for _ in range(iters):
+    fn()
+  return (time.perf_counter() - start) / iters
+
+
+def random_batch(batch_size, max_len, spec_channels=513, hop_length=256, min_len=32, speakers=False):
+  """Synthetic (text, spec, wav[, sid]) items with spec lengths in [min_len, max_len]."""
+  g = torch.Generator().manual_seed(1234)
+  batch = []
+  for _ in range(batch_size):
+    t = int(torch.randint(min_len, max_len + 1, (1,), generator=g))
+    item = (
+      torch.randint(0, 100, (t // 3 + 1,), generator=g),
+      torch.rand(spec_channels, t, generator=g),
+      torch.rand(1, t * hop_length, generator=g) * 2 - 1)
+    if speakers:
+      item = item + (torch.LongTensor([int(torch.randint(0, 100, (1,), generator=g))]),)
+    batch.append(item)
+  return batch
+
+
+def bench_collate(args):
+  from data_utils import TextAudioCollate, TextAudioSpeakerCollate
+
+  batch = random_batch(args.batch_size, args.max_len, speakers=args.speakers)
+  cls = TextAudioSpeakerCollate if args.speakers else TextAudioCollate
+  for name, collate_fn in [
+      ("fresh", cls(pad_multiple=8)),
+      ("reuse_buffers", cls(pad_multiple=8, reuse_buffers=True, max_spec_len=args.max_len))]:
+    t = timeit(lambda: collate_fn(batch), args.iters)
+    print("collate/{:<14s} batch={:<4d} max_len={:<5d} {:8.2f} ms/batch".format(
+      name, args.batch_size, args.max_len, t * 1e3))
+
+
+def _private_dirty_kb():
+  with open("/proc/self/smaps_rollup") as f:
+    for line in f:
+      if line.startswith("Private_Dirty:"):
+        return int(line.split()[1])
+
+
+def _read_all_rows(rows, queue):
+  before = _private_dirty_kb()
+  for i in range(len(rows)):
+    row = rows[i]
+    audiopath, text = row[0], row[-1]
+  queue.put(_private_dirty_kb() - before)
+
+
+def bench_manifest(args):
+  """Memory a forked worker copies when it reads every row of the manifest."""
+  from data_utils import Manifest
+
+  rows = [["DUMMY/LJ{:03d}-{:04d}.wav".format(i // 10000, i % 10000), str(i % 100),
+           "printing, in the only sense with which we are at present concerned {}".format(i)]
+          for i in range(args.rows)]
+  start = time.perf_counter()
+  manifest = Manifest(rows, 3, int_columns=(1,))
+  build_time = time.perf_counter() - start
+  print("manifest/build       rows={:<9d} {:8.2f} s, {:8.1f} MB of arrays".format(
+    args.rows, build_time, manifest.nbytes / 2**20))
+
+  ctx = multiprocessing.get_context("fork")
+  for name, obj in [("list", rows), ("arrays", manifest)]:
+    queue = ctx.Queue()
+    p = ctx.Process(target=_read_all_rows, args=(obj, queue))
+    p.start()
+    copied = queue.get()
+    p.join()
+    print("manifest/{:<11s} rows={:<9d} {:8.1f} MB copied into worker".format(name, args.rows, copied / 2**10))
+
+
+def bench_wav(args):
+  """Load cost and bytes shipped to the main process per batch, float32 vs int16."""
+  from scipy.io.wavfile import write
+  from utils import load_wav_to_torch, load_wav_to_torch_int16
+
+  rng = np.random.default_rng(1234)
+  with tempfile.TemporaryDirectory() as tmp:
+    paths = []
+    for i in range(args.files):
+      paths.append(os.path.join(tmp, "{}.wav".format(i)))
+      write(paths[-1], 22050, rng.integers(-2**15, 2**15, int(22050 * args.seconds), dtype=np.int16))
+
+    def load_float():
+      return [load_wav_to_torch(p)[0] / 32768.0 for p in paths]
+
+    def load_int16():
+      return [load_wav_to_torch_int16(p)[0] for p in paths]
+
+    for name, fn in [("float32", load_float), ("int16_mmap", load_int16)]:
+      t = timeit(fn, args.iters)
+      nbytes = sum(w.numel() * w.element_size() for w in fn())
+      print("wav/{:<11s} files={:<4d} {:8.2f} ms/batch, {:8.1f} MB/batch to main process".format(
+        name, args.files, t * 1e3, nbytes / 2**20))
+
+    y = torch.stack(load_int16())
+    t = timeit(lambda: y.float() / 32768.0, args.iters)
+    print("wav/{:<11s} files={:<4d} {:8.2f} ms/batch".format("normalize", args.files, t * 1e3))
+
+
+def _legacy_subband_stft_loss(h, y, y_hat_mb):
+  """Subband loss as computed before SubbandSTFTLoss: new PQMF, one STFT per signal and resolution"""
+  from pqmf import PQMF
+  from stft_loss import stft
+
+  y_mb = PQMF(y.device, h.model.subbands).analysis(y)
+  y_mb = y_mb.view(-1, y_mb.size(2))
+  y_hat_mb = y_hat_mb.view(-1, y_hat_mb.size(2))[:, :y_mb.size(-1)]
+  sc_loss, mag_loss = 0., 0.
+  for fs, ss, wl in zip(h.train.fft_sizes, h.train.hop_sizes, h.train.win_lengths):
+    window = torch.hann_window(wl)
+    x_mag = stft(y_hat_mb, fs, ss, wl, window)
+    y_mag = stft(y_mb, fs, ss, wl, window)
+    sc_loss += torch.norm(y_mag - x_mag, p="fro") / torch.norm(y_mag, p="fro")
+    mag_loss += torch.nn.functional.l1_loss(torch.log(y_mag), torch.log(x_mag))
+  return (sc_loss + mag_loss) / len(h.train.fft_sizes)
+
+
+def bench_subband(args):
+  """Per-step subband STFT loss (forward + backward), legacy vs SubbandSTFTLoss"""
+  import utils
+  from losses import SubbandSTFTLoss
+
+  h = utils.get_hparams_from_file(args.config)
+  device = torch.device(args.device)
+  g = torch.Generator().manual_seed(1234)
+  y = (torch.rand(args.batch_size, 1, h.train.segment_size, generator=g) * 2 - 1).to(device)
+  y_hat_mb = (torch.rand(args.batch_size, h.model.subbands, h.train.segment_size // h.model.subbands, generator=g) - .5)
+  y_hat_mb = y_hat_mb.to(device).requires_grad_()
+  subband_loss = SubbandSTFTLoss.from_hparams(h).to(device)
+
+  def sync():
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+
+  results = {}
+  for name, loss_fn in [("legacy", lambda: _legacy_subband_stft_loss(h, y, y_hat_mb)),
+                        ("cached", lambda: subband_loss(y, y_hat_mb))]:
+    def step():
+      y_hat_mb.grad = None
+      loss = loss_fn()
+      loss.backward()
+      sync()
+      return loss
+    t = timeit(step, args.iters)
+    results[name] = (step().detach(), y_hat_mb.grad.clone())
+    print("subband/{:<7s} batch={:<4d} {:8.2f} ms/step".format(name, args.batch_size, t * 1e3))
+  print("subband/max_abs_diff loss={:.3e} grad={:.3e}".format(
+    (results["legacy"][0] - results["cached"][0]).abs().item(),
+    (results["legacy"][1] - results["cached"][1]).abs().max().item()))
+
+
+def bench_mel(args):
+  """MelSpectrogram module vs the mel_processing functions: max abs difference and time per call"""
+  import utils
+  from mel_processing import MelSpectrogram, mel_spectrogram_torch, spec_to_mel_torch, spectrogram_torch
+
+  h = utils.get_hparams_from_file(args.config).data
+  device = torch.device(args.device)
+  g = torch.Generator().manual_seed(1234)
+  y = (torch.rand(args.batch_size, args.segment_size, generator=g) * 1.8 - .9).to(device)
+  mel_fn = MelSpectrogram.from_hparams(h).to(device)
+
+  def legacy():
+    return mel_spectrogram_torch(y, h.filter_length, h.n_mel_channels, h.sampling_rate,
+                                 h.hop_length, h.win_length, h.mel_fmin, h.mel_fmax)
+
+  spec = mel_fn.spectrogram(y)
+  diffs = {
+    "spectrogram": (spec - spectrogram_torch(y, h.filter_length, h.sampling_rate, h.hop_length, h.win_length)).abs().max(),
+    "spec_to_mel": (mel_fn.spec_to_mel(spec) - spec_to_mel_torch(
+      spec, h.filter_length, h.n_mel_channels, h.sampling_rate, h.mel_fmin, h.mel_fmax)).abs().max(),
+    "mel": (mel_fn(y) - legacy()).abs().max()}
+  for name, diff in diffs.items():
+    print("mel/max_abs_diff {:<12s} {:.3e}".format(name, diff.item()))
+
+  for name, fn in [("function", legacy), ("module", lambda: mel_fn(y))]:
+    def step():
+      fn()
+      if device.type == "cuda":
+        torch.cuda.synchronize()
+    print("mel/{:<9s} batch={:<4d} {:8.2f} ms/call".format(name, args.batch_size, timeit(step, args.iters) * 1e3))
+
+
+def bench_disc(args):
+  """Discriminator work of one training step (D step + G step), two passes vs batched real/fake"""
+  from losses import discriminator_loss, feature_loss, generator_loss
+  from models import MultiPeriodDiscriminator
+
+  device = torch.device(args.device)
+  g = torch.Generator().manual_seed(1234)
+  net_d = MultiPeriodDiscriminator().to(device)
+  y = (torch.rand(args.batch_size, 1, args.segment_size, generator=g) * 2 - 1).to(device)
+  y_hat = (torch.rand(args.batch_size, 1, args.segment_size, generator=g) * 2 - 1).to(device).requires_grad_()
+
+  y_d_r, y_d_g, fmap_r, fmap_g = net_d(y, y_hat)
+  b_d_r, b_d_g, b_fmap_r, b_fmap_g = net_d(y, y_hat, concat=True, detach_fmap=True)
+  diff = max((a - b).abs().max().item() for a, b in zip(y_d_r + y_d_g, b_d_r + b_d_g))
+  diff = max([diff] + [(a - b).abs().max().item() for x, z in zip(fmap_r + fmap_g, b_fmap_r + b_fmap_g) for a, b in zip(x, z)])
+  print("disc/max_abs_diff concat vs two passes {:.3e}".format(diff))
+
+  def step(batched):
+    net_d.zero_grad()
+    if batched:
+      d_r, d_g, f_r, _ = net_d(y, y_hat.detach(), concat=True, detach_fmap=True)
+    else:
+      d_r, d_g, _, _ = net_d(y, y_hat.detach())
+    discriminator_loss(d_r, d_g)[0].backward()
+    if batched:
+      _, d_g, _, f_g = net_d(None, y_hat)
+    else:
+      _, d_g, f_r, f_g = net_d(y, y_hat)
+    (generator_loss(d_g)[0] + feature_loss(f_r, f_g)).backward()
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+
+  for name, batched in [("two_pass", False), ("batched", True)]:
+    print("disc/{:<9s} batch={:<4d} {:8.2f} ms/step".format(
+      name, args.batch_size, timeit(lambda: step(batched), args.iters) * 1e3))
+
+
+def _legacy_clip_grad_value_(parameters, clip_value, norm_type=2):
+  """commons.clip_grad_value_ before foreach: one norm and one .item() per parameter"""
+  parameters = list(filter(lambda p: p.grad is not None, parameters))
+  total_norm = 0
+  for p in parameters:
+    param_norm = p.grad.data.norm(norm_type)
+    total_norm += param_norm.item() ** norm_type
+    if clip_value is not None:
+      p.grad.data.clamp_(min=-clip_value, max=clip_value)
+  return total_norm ** (1. / norm_type)
+
+
+def bench_gradnorm(args):
+  """Gradient norm of SynthesizerTrn + MultiPeriodDiscriminator, per-parameter .item() vs foreach"""
+  import commons
+  import utils
+  from models import MultiPeriodDiscriminator, SynthesizerTrn
+  from text.symbols import symbols
+
+  h = utils.get_hparams_from_file(args.config)
+  device = torch.device(args.device)
+  net_g = SynthesizerTrn(len(symbols), h.data.filter_length // 2 + 1,
+                         h.train.segment_size // h.data.hop_length, **h.model).to(device)
+  net_d = MultiPeriodDiscriminator().to(device)
+  for p in itertools.chain(net_g.parameters(), net_d.parameters()):
+    p.grad = torch.randn_like(p)
+
+  legacy = _legacy_clip_grad_value_(net_g.parameters(), None) + _legacy_clip_grad_value_(net_d.parameters(), None)
+  new = commons.clip_grad_value_(net_g.parameters(), None) + commons.clip_grad_value_(net_d.parameters(), None)
+  print("gradnorm/rel_diff {:.3e} over {} tensors".format(
+    abs(legacy - new.item()) / legacy, len(list(net_g.parameters())) + len(list(net_d.parameters()))))
+
+  def step(fn):
+    fn(net_g.parameters(), None)
+    fn(net_d.parameters(), None)
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+
+  for name, fn in [("per_param", _legacy_clip_grad_value_), ("foreach", commons.clip_grad_value_)]:
+    print("gradnorm/{:<10s} {:8.2f} ms/step (G + D)".format(name, timeit(lambda: step(fn), args.iters) * 1e3))
+
+
+def _legacy_slice_segments(x, ids_str, segment_size=4):
+  """commons.slice_segments before the gather: one copy per batch item"""
+  ret = torch.zeros_like(x[:, :, :segment_size])
+  for i in range(x.size(0)):
+    idx_str = ids_str[i]
+    idx_end = idx_str + segment_size
+    ret[i] = x[i, :, idx_str:idx_end]
+  return ret
+
+
+def bench_slice(args):
+  """slice_segments on the three per-step shapes (z, mel, y), per-item loop vs batched"""
+  import commons
+
+  device = torch.device(args.device)
+  g = torch.Generator().manual_seed(1234)
+  frames, hop, segment = 800, 256, 32
+  for b in args.batch_sizes:
+    for name, channels, t, size, scale in [("z", 192, frames, segment, 1), ("mel", 80, frames, segment, 1),
+                                           ("y", 1, frames * hop, segment * hop, hop)]:
+      x = torch.randn(b, channels, t, generator=g).to(device).requires_grad_(name == "z")
+      ids = torch.randint(0, frames - segment + 1, (b,), generator=g).to(device) * scale
+      out_legacy, out = _legacy_slice_segments(x, ids, size), commons.slice_segments(x, ids, size)
+      assert torch.equal(out_legacy, out), name
+      if x.requires_grad:
+        grad_legacy, = torch.autograd.grad(out_legacy.square().sum(), x)
+        grad, = torch.autograd.grad(out.square().sum(), x)
+        assert torch.equal(grad_legacy, grad), name
+
+      def step(fn):
+        out = fn(x, ids, size)
+        if x.requires_grad:
+          out.sum().backward()
+        if device.type == "cuda":
+          torch.cuda.synchronize()
+
+      t_legacy = timeit(lambda: step(_legacy_slice_segments), args.iters)
+      t_new = timeit(lambda: step(commons.slice_segments), args.iters)
+      print("slice/{:<4s} batch={:<4d} loop {:8.3f} ms, batched {:8.3f} ms ({:.1f}x)".format(
+        name, b, t_legacy * 1e3, t_new * 1e3, t_legacy / t_new))
+
+
+def _random_alignment_inputs(b, t_text, t_frames, device, g):
+  """neg_cent and mask for b items with random lengths, the first one full size"""
+  t_ys = torch.randint(t_frames // 2, t_frames + 1, (b,), generator=g)
+  t_xs = torch.minimum(torch.randint(t_text // 2, t_text + 1, (b,), generator=g), t_ys)
+  t_ys[0], t_xs[0] = t_frames, min(t_text, t_frames)
+  mask = ((torch.arange(t_frames)[None, :, None] < t_ys[:, None, None]) &
+          (torch.arange(t_text)[None, None, :] < t_xs[:, None, None])).float()
+  neg_cent = torch.randn(b, t_frames, t_text, generator=g) * 10
+  return neg_cent.to(device), mask.to(device)
+
+
+def bench_mas(args):
+  """maximum_path backends: cross-check against each other, then time by (batch, T_text, T_frames)"""
+  import monotonic_align
+
+  device = torch.device(args.device)
+  g = torch.Generator().manual_seed(1234)
+  names = sorted(monotonic_align.BACKENDS)
+  print("mas/backends {} (auto: {})".format(names, monotonic_align.get_backend(device)))
+  for shape in args.shapes:
+    b, t_text, t_frames = map(int, shape.split("x"))
+    neg_cent, mask = _random_alignment_inputs(b, t_text, t_frames, device, g)
+    paths = {name: monotonic_align.maximum_path(neg_cent, mask, name) for name in names}
+    for name in names:
+      assert torch.equal(paths[name], paths[names[0]]), "{} and {} disagree".format(name, names[0])
+      # a monotonic path visits every valid frame exactly once
+      assert torch.equal(paths[name].sum(2), mask[:, :, 0]), name
+
+    def step(name):
+      monotonic_align.maximum_path(neg_cent, mask, name)
+      if device.type == "cuda":
+        torch.cuda.synchronize()
+
+    times = ", ".join("{} {:8.2f} ms".format(name, timeit(lambda: step(name), args.iters) * 1e3) for name in names)
+    print("mas/b={:<3d} t_text={:<4d} t_frames={:<5d} {}".format(b, t_text, t_frames, times))
+
+
+def _legacy_alignment(z_p, m_p, logs_p, x_mask, y_mask):
+  """SynthesizerTrn alignment before the fused neg_cent: four full-size terms, attn_mask and a copying MAS"""
+  import math
+  import monotonic_align
+
+  s_p_sq_r = torch.exp(-2 * logs_p)
+  neg_cent1 = torch.sum(-0.5 * math.log(2 * math.pi) - logs_p, [1], keepdim=True)
+  neg_cent2 = torch.matmul(-0.5 * (z_p ** 2).transpose(1, 2), s_p_sq_r)
+  neg_cent3 = torch.matmul(z_p.transpose(1, 2), (m_p * s_p_sq_r))
+  neg_cent4 = torch.sum(-0.5 * (m_p ** 2) * s_p_sq_r, [1], keepdim=True)
+  neg_cent = neg_cent1 + neg_cent2 + neg_cent3 + neg_cent4
+  attn_mask = torch.unsqueeze(x_mask, 2) * torch.unsqueeze(y_mask, -1)
+  return neg_cent, monotonic_align.maximum_path(neg_cent, attn_mask.squeeze(1)).unsqueeze(1)
+
+
+def _fused_alignment(z_p, m_p, logs_p, x_mask, y_mask, keep_neg_cent=True):
+  """Same computation as SynthesizerTrn.forward"""
+  import commons
+  import monotonic_align
+
+  neg_cent = commons.neg_cent(z_p, m_p, logs_p)
+  path = monotonic_align.maximum_path_lengths(
+    neg_cent.clone() if keep_neg_cent else neg_cent, y_mask.sum([1, 2]), x_mask.sum([1, 2]), overwrite=True)
+  return neg_cent if keep_neg_cent else None, path.unsqueeze(1)
+
+
+def _alignment_inputs(args, device):
+  import commons
+
+  g = torch.Generator().manual_seed(1234)
+  b, d = args.batch_size, args.channels
+  x_lengths = torch.randint(args.t_text // 2, args.t_text + 1, (b,), generator=g)
+  y_lengths = torch.maximum(torch.randint(args.t_frames // 2, args.t_frames + 1, (b,), generator=g), x_lengths)
+  x_lengths[0], y_lengths[0] = args.t_text, args.t_frames
+  x_mask = commons.sequence_mask(x_lengths, args.t_text).unsqueeze(1).float()
+  y_mask = commons.sequence_mask(y_lengths, args.t_frames).unsqueeze(1).float()
+  z_p = torch.randn(b, d, args.t_frames, generator=g) * y_mask
+  m_p = torch.randn(b, d, args.t_text, generator=g) * x_mask
+  logs_p = torch.randn(b, d, args.t_text, generator=g) * 0.1 * x_mask
+  return [t.to(device) for t in (z_p, m_p, logs_p, x_mask, y_mask)]
+
+
+def _peak_alignment_memory(fn, args, device, queue):
+  inputs = _alignment_inputs(args, device)
+  if device.type == "cuda":
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+  else:
+    with open("/proc/self/clear_refs", "w") as f: # reset VmHWM to the current RSS
+      f.write("5")
+    base = _status_kb("VmRSS") * 1024
+  with torch.no_grad():
+    path = fn(*inputs, keep_neg_cent=False)[1] if fn is _fused_alignment else fn(*inputs)[1]
+  if device.type == "cuda":
+    peak = torch.cuda.max_memory_allocated()
+  else:
+    peak = _status_kb("VmHWM") * 1024
+  queue.put((peak - base, int(path.sum())))
+
+
+def _status_kb(key):
+  with open("/proc/self/status") as f:
+    for line in f:
+      if line.startswith(key + ":"):
+        return int(line.split()[1])
+
+
+def bench_negcent(args):
+  """Alignment scores + MAS in SynthesizerTrn.forward, legacy vs fused: equivalence, time and peak memory"""
+  device = torch.device(args.device)
+  inputs = _alignment_inputs(args, device)
+  with torch.no_grad():
+    neg_cent_legacy, path_legacy = _legacy_alignment(*inputs)
+    neg_cent, path = _fused_alignment(*inputs)
+  rel = ((neg_cent - neg_cent_legacy).abs().max() / neg_cent_legacy.abs().max()).item()
+  print("negcent/max_rel_diff {:.3e}, paths differ in {} of {} frames".format(
+    rel, int((path != path_legacy).any(-1).sum()), int(inputs[4].sum())))
+
+  ctx = multiprocessing.get_context("spawn" if device.type == "cuda" else "fork")
+  for name, fn in [("legacy", _legacy_alignment), ("fused", _fused_alignment)]:
+    with torch.no_grad():
+      t = timeit(lambda: fn(*inputs), args.iters)
+    queue = ctx.Queue()
+    p = ctx.Process(target=_peak_alignment_memory, args=(fn, args, device, queue))
+    p.start()
+    peak, _ = queue.get()
+    p.join()
+    print("negcent/{:<7s} b={} t_text={} t_frames={} {:8.2f} ms, peak {:8.1f} MB above inputs".format(
+      name, args.batch_size, args.t_text, args.t_frames, t * 1e3, peak / 2**20))
+
+
+def _checkpointing_setup(args, device):
+  import utils
+  from models import SynthesizerTrn
+  from text.symbols import symbols
+
+  h = utils.get_hparams_from_file(args.config)
+  torch.manual_seed(1234)
+  net_g = SynthesizerTrn(len(symbols), h.data.filter_length // 2 + 1,
+                         h.train.segment_size // h.data.hop_length, **h.model).to(device)
+  g = torch.Generator().manual_seed(1234)
+  b = args.batch_size
+  x = torch.randint(1, len(symbols), (b, args.t_text), generator=g)
+  x_lengths = torch.randint(args.t_text // 2, args.t_text + 1, (b,), generator=g)
+  spec = torch.rand(b, h.data.filter_length // 2 + 1, args.t_frames, generator=g)
+  spec_lengths = torch.randint(args.t_frames // 2, args.t_frames + 1, (b,), generator=g)
+  x_lengths[0], spec_lengths[0] = args.t_text, args.t_frames
+  return net_g, [t.to(device) for t in (x, x_lengths, spec, spec_lengths)]
+
+
+def _checkpointing_step(net_g, inputs, mode, count_saved=False):
+  """One generator forward + backward through all three stacks; returns the bytes of
+  activations saved for backward (when count_saved, else 0)"""
+  from losses import kl_loss
+
+  mode = None if mode == "none" else mode
+  net_g.set_gradient_checkpointing(enc_q=mode, flow=mode, enc_p=mode)
+  net_g.zero_grad(set_to_none=True)
+  storages = {}
+  def pack(t): # tensors saved inside a checkpointed region are not passed here
+    storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+    return t
+  torch.manual_seed(1234) # same dropout masks, noise and slices in every mode
+  with torch.autograd.graph.saved_tensors_hooks(pack if count_saved else (lambda t: t), lambda t: t):
+    y_hat, _, l_length, _, _, _, z_mask, (_, z_p, m_p, logs_p, _, logs_q) = net_g(*inputs)
+    loss = y_hat.pow(2).mean() + l_length.sum() + kl_loss(z_p, logs_q, m_p, logs_p, z_mask)
+  loss.backward()
+  if inputs[0].is_cuda:
+    torch.cuda.synchronize()
+  return sum(storages.values())
+
+
+def bench_checkpointing(args):
+  """Generator step with activation checkpointing of enc_q, flow and enc_p off / per layer / per block:
+  gradient equivalence, time, activations saved for backward and (CUDA) peak memory"""
+  device = torch.device(args.device)
+  net_g, inputs = _checkpointing_setup(args, device)
+  _checkpointing_step(net_g, inputs, "none")
+  reference = {n: p.grad.clone() for n, p in net_g.named_parameters() if p.grad is not None}
+
+  for mode in ["none", "layer", "block"]:
+    if device.type == "cuda":
+      torch.cuda.reset_peak_memory_stats()
+      base = torch.cuda.memory_allocated()
+    saved = _checkpointing_step(net_g, inputs, mode, count_saved=True)
+    peak = " peak {:8.1f} MB,".format((torch.cuda.max_memory_allocated() - base) / 2**20) if device.type == "cuda" else ""
+    rel = max(((p.grad - reference[n]).abs().max() / reference[n].abs().max().clamp_min(1e-12)).item()
+              for n, p in net_g.named_parameters() if n in reference)
+    t = timeit(lambda: _checkpointing_step(net_g, inputs, mode), args.iters, warmup=1)
+    print("checkpointing/{:<5s} b={} t_text={} t_frames={} {:8.1f} ms/step, saved activations {:8.1f} MB,{} grad max_rel_diff {:.1e}".format(
+      mode, args.batch_size, args.t_text, args.t_frames, t * 1e3, saved / 2**20, peak, rel))
+
+
+def bench_compile(args):
+  """dec + MultiPeriodDiscriminator forward/backward on a training segment, eager vs torch.compile:
+  output difference, compile time and step time"""
+  import utils
+  from models import MultiPeriodDiscriminator, SynthesizerTrn
+  from text.symbols import symbols
+
+  h = utils.get_hparams_from_file(args.config)
+  device = torch.device(args.device)
+  segment_frames = h.train.segment_size // h.data.hop_length
+  torch.manual_seed(1234)
+  dec = SynthesizerTrn(len(symbols), h.data.filter_length // 2 + 1, segment_frames, **h.model).dec.to(device)
+  net_d = MultiPeriodDiscriminator(h.model.use_spectral_norm).to(device)
+  g = torch.Generator().manual_seed(1234)
+  z = torch.randn(args.batch_size, h.model.inter_channels, segment_frames, generator=g).to(device)
+  y = (torch.rand(args.batch_size, 1, h.train.segment_size, generator=g) * 2 - 1).to(device)
+
+  def step():
+    dec.zero_grad()
+    net_d.zero_grad()
+    y_hat, _ = dec(z)
+    _, y_d_g, _, fmap_g = net_d(y, y_hat)
+    loss = sum(d.mean() for d in y_d_g) + sum(f.abs().mean() for fmap in fmap_g for f in fmap)
+    loss.backward()
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+    return y_hat.detach()
+
+  y_hat_eager = step()
+  eager = timeit(step, args.iters)
+  dec.compile()
+  net_d.compile()
+  start = time.perf_counter()
+  y_hat = step()
+  compile_sec = time.perf_counter() - start
+  compiled = timeit(step, args.iters)
+  print("compile/max_abs_diff dec output {:.3e}, first compiled step (compilation) {:.1f} s".format(
+    (y_hat - y_hat_eager).abs().max().item(), compile_sec))
+  for name, t in [("eager", eager), ("compiled", compiled)]:
+    print("compile/{:<8s} b={} segment={} {:8.1f} ms/step (dec + D forward/backward)".format(
+      name, args.batch_size, h.train.segment_size, t * 1e3))
+
+
+def _legacy_relative_attention(attn, query, key, value, mask):
+  """MultiHeadAttention.attention before the banded relative terms: the embeddings are padded to all
+  2 * t - 1 relative positions and shifted to absolute positions with pad/reshape ([b, h, t, 2t-1] per term)"""
+  import math
+  import torch.nn.functional as F
+
+  def get_relative_embeddings(relative_embeddings, length):
+    pad_length = max(length - (attn.window_size + 1), 0)
+    slice_start_position = max((attn.window_size + 1) - length, 0)
+    if pad_length > 0:
+      relative_embeddings = F.pad(relative_embeddings, [0, 0, pad_length, pad_length])
+    return relative_embeddings[:, slice_start_position:slice_start_position + 2 * length - 1]
+
+  def relative_to_absolute(x):
+    batch, heads, length, _ = x.size()
+    x_flat = F.pad(x, [0, 1]).view([batch, heads, length * 2 * length])
+    x_flat = F.pad(x_flat, [0, length - 1])
+    return x_flat.view([batch, heads, length + 1, 2 * length - 1])[:, :, :length, length - 1:]
+
+  def absolute_to_relative(x):
+    batch, heads, length, _ = x.size()
+    x_flat = F.pad(x, [0, length - 1]).view([batch, heads, length**2 + length * (length - 1)])
+    x_flat = F.pad(x_flat, [length, 0])
+    return x_flat.view([batch, heads, length, 2 * length])[:, :, :, 1:]
+
+  b, d, t = key.size()
+  query = query.view(b, attn.n_heads, attn.k_channels, t).transpose(2, 3)
+  key = key.view(b, attn.n_heads, attn.k_channels, t).transpose(2, 3)
+  value = value.view(b, attn.n_heads, attn.k_channels, t).transpose(2, 3)
+  query = query / math.sqrt(attn.k_channels)
+  scores = torch.matmul(query, key.transpose(-2, -1))
+  rel_logits = torch.matmul(query, get_relative_embeddings(attn.emb_rel_k, t).unsqueeze(0).transpose(-2, -1))
+  scores = scores + relative_to_absolute(rel_logits)
+  scores = scores.masked_fill(mask == 0, -1e4)
+  p_attn = attn.drop(F.softmax(scores, dim=-1))
+  output = torch.matmul(p_attn, value)
+  output = output + torch.matmul(absolute_to_relative(p_attn), get_relative_embeddings(attn.emb_rel_v, t).unsqueeze(0))
+  return output.transpose(2, 3).contiguous().view(b, d, t), p_attn
+
+
+def bench_attention(args):
+  """Relative-position self-attention of the text encoder, legacy 2t-1 relative terms vs the banded ones:
+  output, attention and gradient difference and forward/backward time"""
+  from attentions import MultiHeadAttention
+
+  device = torch.device(args.device)
+  torch.manual_seed(1234)
+  attn = MultiHeadAttention(args.channels, args.channels, args.n_heads, window_size=args.window_size).to(device)
+  for t in args.lengths:
+    g = torch.Generator().manual_seed(t)
+    x = torch.randn(args.batch_size, args.channels, t, generator=g).to(device)
+    lengths = torch.randint(t // 2, t + 1, (args.batch_size,), generator=g).to(device)
+    x_mask = (torch.arange(t, device=device)[None, :] < lengths[:, None]).unsqueeze(1).float()
+    mask = x_mask.unsqueeze(2) * x_mask.unsqueeze(-1)
+    q, k, v = attn.conv_q(x).detach(), attn.conv_k(x).detach(), attn.conv_v(x).detach()
+
+    def step(fn):
+      attn.zero_grad()
+      inputs = [a.clone().requires_grad_() for a in (q, k, v)]
+      out, p_attn = fn(*inputs, mask)
+      out.square().sum().backward()
+      if device.type == "cuda":
+        torch.cuda.synchronize()
+      return out.detach(), p_attn.detach(), [a.grad for a in inputs] + [attn.emb_rel_k.grad.clone(), attn.emb_rel_v.grad.clone()]
+
+    legacy = lambda *a: _legacy_relative_attention(attn, *a)
+    out_l, p_l, grads_l = step(legacy)
+    out_b, p_b, grads_b = step(attn.attention)
+    grad_diff = max(((a - b).abs().max() / a.abs().max()).item() for a, b in zip(grads_l, grads_b))
+    print("attention/max_abs_diff t={} output {:.1e}, attention {:.1e}, grad max_rel_diff {:.1e}".format(
+      t, (out_b - out_l).abs().max().item(), (p_b - p_l).abs().max().item(), grad_diff))
+    for name, fn in [("legacy", legacy), ("banded", attn.attention)]:
+      sec = timeit(lambda: step(fn), args.iters)
+      print("attention/{:<6s} b={} t={} {:8.2f} ms (forward + backward)".format(name, args.batch_size, t, sec * 1e3))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--iters", type=int, default=10)
+  parser.add_argument("--threads", type=int, default=None)
+  subparsers = parser.add_subparsers(dest="bench", required=True)
+
+  p = subparsers.add_parser("collate", help="per-batch cost of TextAudio(Speaker)Collate")
+  p.add_argument("--batch_size", type=int, default=64)
+  p.add_argument("--max_len", type=int, default=800)
+  p.add_argument("--speakers", action="store_true")
+  p.set_defaults(func=bench_collate)
+
+  p = subparsers.add_parser("manifest", help="worker copy-on-write growth, list-of-lists vs Manifest")
+  p.add_argument("--rows", type=int, default=1000000)
+  p.set_defaults(func=bench_manifest)
+
+  p = subparsers.add_parser("wav", help="float32 vs memory-mapped int16 wav loading")
+  p.add_argument("--files", type=int, default=64)
+  p.add_argument("--seconds", type=float, default=8.)
+  p.set_defaults(func=bench_wav)
+
+  p = subparsers.add_parser("subband", help="subband STFT loss, legacy vs cached module")
+  p.add_argument("-c", "--config", default="configs/ljs_mb_istft_vits.json")
+  p.add_argument("--batch_size", type=int, default=64)
+  p.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+  p.set_defaults(func=bench_subband)
+
+  p = subparsers.add_parser("mel", help="MelSpectrogram module vs mel_spectrogram_torch")
+  p.add_argument("-c", "--config", default="configs/ljs_mb_istft_vits.json")
+  p.add_argument("--batch_size", type=int, default=64)
+  p.add_argument("--segment_size", type=int, default=8192)
+  p.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+  p.set_defaults(func=bench_mel)
+
+  p = subparsers.add_parser("disc", help="discriminator passes per step, two passes vs batched real/fake")
+  p.add_argument("--batch_size", type=int, default=16)
+  p.add_argument("--segment_size", type=int, default=8192)
+  p.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+  p.set_defaults(func=bench_disc)
+
+  p = subparsers.add_parser("gradnorm", help="gradient norm of G and D, per-parameter .item() vs foreach")
+  p.add_argument("-c", "--config", default="configs/ljs_mb_istft_vits.json")
+  p.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+  p.set_defaults(func=bench_gradnorm)
+
+  p = subparsers.add_parser("slice", help="slice_segments, per-item loop vs batched")
+  p.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 16, 64])
+  p.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+  p.set_defaults(func=bench_slice)
+
+  p = subparsers.add_parser("mas", help="monotonic alignment search backends, cross-check and timing")
+  p.add_argument("--shapes", nargs="+", default=["16x100x400", "64x200x400", "64x400x800"],
+                 help="batch x T_text x T_frames")
+  p.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+  p.set_defaults(func=bench_mas)
+
+  p = subparsers.add_parser("negcent", help="alignment scores + MAS, legacy vs fused neg_cent")
+  p.add_argument("--batch_size", type=int, default=64)
+  p.add_argument("--t_text", type=int, default=400)
+  p.add_argument("--t_frames", type=int, default=800)
+  p.add_argument("--channels", type=int, default=192)
+  p.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+  p.set_defaults(func=bench_negcent)
+
+  p = subparsers.add_parser("checkpointing", help="activation checkpointing of enc_q / flow / enc_p, memory vs time")
+  p.add_argument("-c", "--config", default="configs/ljs_mb_istft_vits.json")
+  p.add_argument("--batch_size", type=int, default=16)
+  p.add_argument("--t_text", type=int, default=200)
+  p.add_argument("--t_frames", type=int, default=800)
+  p.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+  p.set_defaults(func=bench_checkpointing)
+
+  p = subparsers.add_parser("compile", help="dec + MultiPeriodDiscriminator step, eager vs torch.compile")
+  p.add_argument("-c", "--config", default="configs/ljs_mb_istft_vits.json")
+  p.add_argument("--batch_size", type=int, default=16)
+  p.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+  p.set_defaults(func=bench_compile)
+
+  p = subparsers.add_parser("attention", help="text encoder relative attention, 2t-1 relative terms vs banded")
+  p.add_argument("--batch_size", type=int, default=16)
+  p.add_argument("--lengths", type=int, nargs="+", default=[50, 200, 600])
+  p.add_argument("--channels", type=int, default=192)
+  p.add_argument("--n_heads", type=int, default=2)
+  p.add_argument("--window_size", type=int, default=4)
+  p.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+  p.set_defaults(func=bench_attention)
+
+  args = parser.parse_args()
+  if args.threads is not None:
+    torch.set_num_threads(args.threads)
+  args.func(args)
+
+
+if __name__ == "__main__":
+  main()
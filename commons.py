@@ -1,6 +1,7 @@
 import math
 import numpy as np
 import torch
+import torch.utils.checkpoint
 from torch import nn
 from torch.nn import functional as F
 
@@ -11,6 +12,15 @@ def init_weights(m, mean=0.0, std=0.01):
     m.weight.data.normal_(mean, std)
 
 
+def checkpoint(fn, *args):
+  """fn(*args) with activation checkpointing while gradients are recorded: its intermediate
+  activations are recomputed in backward instead of stored (with the same RNG state, so
+  dropout masks match)"""
+  if torch.is_grad_enabled():
+    return torch.utils.checkpoint.checkpoint(fn, *args, use_reentrant=False)
+  return fn(*args)
+
+
 def get_padding(kernel_size, dilation=1):
   return int((kernel_size*dilation - dilation)/2)
 
@@ -46,12 +56,14 @@ def rand_gumbel_like(x):
 
 
 def slice_segments(x, ids_str, segment_size=4):
-  ret = torch.zeros_like(x[:, :, :segment_size])
-  for i in range(x.size(0)):
-    idx_str = ids_str[i]
-    idx_end = idx_str + segment_size
-    ret[i] = x[i, :, idx_str:idx_end]
-  return ret
+  """x[i, :, ids_str[i]:ids_str[i] + segment_size] for every i, without a per-item loop"""
+  ids_str = ids_str.to(x.device)
+  if x.requires_grad:
+    # gather backward is a single scatter-add; unfold backward is far slower
+    idx = ids_str.view(-1, 1, 1) + torch.arange(segment_size, device=x.device)
+    return torch.gather(x, 2, idx.expand(x.size(0), x.size(1), segment_size))
+  # contiguous window copies, cheaper than gather's per-element index
+  return x.unfold(2, segment_size, 1)[torch.arange(x.size(0), device=x.device), :, ids_str]
 
 
 def rand_slice_segments(x, x_lengths=None, segment_size=4):
@@ -125,6 +137,26 @@ def sequence_mask(length, max_length=None):
   return x.unsqueeze(0) < length.unsqueeze(1)
 
 
+def neg_cent(z_p, m_p, logs_p, chunk_size=128):
+  """Negative cross-entropy of z_p under N(m_p, exp(logs_p)) for every (frame, token) pair.
+  z_p: [b, d, t_t], m_p, logs_p: [b, d, t_s] -> [b, t_t, t_s]
+
+  The two matmul terms share one bmm over the stacked [-z_p^2 / 2, z_p] and
+  [s_p_sq_r, m_p * s_p_sq_r] operands with the t_t-independent terms as its bias,
+  tiled over chunk_size frames so that no other [b, t_t, *] tensor is allocated.
+  """
+  s_p_sq_r = torch.exp(-2 * logs_p) # [b, d, t_s]
+  bias = torch.sum(-0.5 * math.log(2 * math.pi) - logs_p - 0.5 * (m_p ** 2) * s_p_sq_r, [1], keepdim=True) # [b, 1, t_s]
+  rhs = torch.cat([s_p_sq_r, m_p * s_p_sq_r], 1) # [b, 2d, t_s]
+  b, _, t_t = z_p.shape
+  out = torch.empty(b, t_t, rhs.size(2), dtype=torch.result_type(z_p, rhs), device=z_p.device)
+  for start in range(0, t_t, chunk_size):
+    z = z_p[:, :, start:start + chunk_size]
+    lhs = torch.cat([-0.5 * (z ** 2), z], 1).transpose(1, 2) # [b, chunk, 2d]
+    out[:, start:start + chunk_size] = torch.baddbmm(bias, lhs, rhs)
+  return out
+
+
 def generate_path(duration, mask):
   """
   duration: [b, 1, t_x]
@@ -144,18 +176,20 @@ def generate_path(duration, mask):
 
 
 def clip_grad_value_(parameters, clip_value, norm_type=2):
+  """Clamp gradients to [-clip_value, clip_value] and return the total gradient norm
+  before clamping as a 0-dim tensor, with foreach kernels and no device sync"""
   if isinstance(parameters, torch.Tensor):
     parameters = [parameters]
-  parameters = list(filter(lambda p: p.grad is not None, parameters))
+  grads = [p.grad for p in parameters if p.grad is not None]
   norm_type = float(norm_type)
-  if clip_value is not None:
-    clip_value = float(clip_value)
+  if len(grads) == 0:
+    return torch.tensor(0.)
 
-  total_norm = 0
-  for p in parameters:
-    param_norm = p.grad.data.norm(norm_type)
-    total_norm += param_norm.item() ** norm_type
+  with torch.no_grad():
+    norms = torch._foreach_norm(grads, norm_type)
+    total_norm = torch.linalg.vector_norm(torch.stack(norms), norm_type)
     if clip_value is not None:
-      p.grad.data.clamp_(min=-clip_value, max=clip_value)
-  total_norm = total_norm ** (1. / norm_type)
+      clip_value = float(clip_value)
+      torch._foreach_clamp_min_(grads, -clip_value)
+      torch._foreach_clamp_max_(grads, clip_value)
   return total_norm
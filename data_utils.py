@@ -1,16 +1,260 @@
 import time
 import os
 import random
+import contextlib
+import fcntl
+import hashlib
 import numpy as np
 import torch
 import torch.utils.data
 
 import commons 
 from mel_processing import spectrogram_torch
-from utils import load_wav_to_torch, load_filepaths_and_text
+from utils import load_wav_to_torch, load_wav_to_torch_int16, load_filepaths_and_text
 from text import text_to_sequence, cleaned_text_to_sequence
 
 
+class Manifest():
+    """ Filelist rows packed into contiguous NumPy arrays, accessed by index.
+
+    Each string column is one utf-8 byte arena plus an int64 offset array and each
+    integer column is an int32 array. Reading a row from a forked DataLoader worker
+    therefore only touches a handful of array objects instead of the refcounts of
+    every list and string in a list-of-lists manifest, which would copy-on-write
+    its pages into every worker.
+    """
+    def __init__(self, rows, num_columns, int_columns=()):
+        columns = list(zip(*rows)) or [()] * num_columns
+        assert len(columns) == num_columns, f"Expected {num_columns} columns, got {len(columns)}"
+        self.num_rows = len(rows)
+        self.columns = []
+        for c, values in enumerate(columns):
+            if c in int_columns:
+                self.columns.append(np.asarray([int(v) for v in values], dtype=np.int32))
+            else:
+                encoded = [v.encode('utf-8') for v in values]
+                offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+                np.cumsum([len(e) for e in encoded], out=offsets[1:])
+                arena = np.frombuffer(b''.join(encoded), dtype=np.uint8).copy()
+                self.columns.append((arena, offsets))
+
+    def get(self, index, column):
+        col = self.columns[column]
+        if isinstance(col, np.ndarray):
+            return int(col[index])
+        arena, offsets = col
+        return arena[offsets[index]:offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, index):
+        return [self.get(index, c) for c in range(len(self.columns))]
+
+    def __len__(self):
+        return self.num_rows
+
+    def __iter__(self):
+        for i in range(self.num_rows):
+            yield self[i]
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes if isinstance(c, np.ndarray) else c[0].nbytes + c[1].nbytes for c in self.columns)
+
+
+class SharedItemCache():
+    """ Node-wide cache of loaded items in shared memory (tmpfs).
+
+    Every item is one file under `root` (default /dev/shm). A hit memory-maps it
+    (`torch.load(mmap=True)`), so all DataLoader workers and all DDP ranks on a node
+    share the same pages instead of each deserializing a copy. The total size is bounded
+    by `max_bytes`: an insert that would exceed it first evicts the least recently used
+    items down to `low_watermark * max_bytes`. Hit, miss, eviction and byte counters
+    live in a small shared block next to the items and are updated under a file lock;
+    the training scripts reset the first three when a run starts.
+
+    The directory name hashes the hparams that change the loaded items, and `file_key`
+    adds the source file's mtime and size to its key, so neither other hparams nor a
+    rewritten wav can be served a stale item. Unused items age out through LRU eviction;
+    directories of other hparams stay until tmpfs is cleared (reboot) or they are removed.
+    """
+    HITS, MISSES, EVICTIONS, BYTES = range(4)
+
+    def __init__(self, name, max_bytes, root="/dev/shm", low_watermark=0.9):
+        self.path = os.path.join(root, name)
+        self.items_path = os.path.join(self.path, "items")
+        self.max_bytes = int(max_bytes)
+        self.low_watermark = low_watermark
+        self.pid = None
+        os.makedirs(self.items_path, exist_ok=True)
+        self._open()
+
+    @classmethod
+    def from_hparams(cls, hparams):
+        """Returns a cache if `hparams.cache_bytes` is set, keyed by everything that changes the loaded items"""
+        max_bytes = getattr(hparams, "cache_bytes", 0)
+        if not max_bytes:
+            return None
+        salt = repr((hparams.max_wav_value, hparams.sampling_rate, hparams.filter_length, hparams.hop_length,
+                     hparams.win_length, getattr(hparams, "int16_audio", False)))
+        name = "vits-cache-" + hashlib.sha1(salt.encode()).hexdigest()[:12]
+        return cls(name, max_bytes, root=getattr(hparams, "cache_dir", "/dev/shm"))
+
+    def _open(self):
+        # flock is per open file description, so each forked worker needs its own descriptor
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.lock_file = open(os.path.join(self.path, "lock"), "a")
+        stats_path = os.path.join(self.path, "stats")
+        with self._locked(init=True):
+            if not os.path.exists(stats_path) or os.path.getsize(stats_path) != 4 * 8:
+                np.zeros(4, dtype=np.int64).tofile(stats_path)
+        self.counters = np.memmap(stats_path, dtype=np.int64, mode="r+", shape=(4,))
+
+    @contextlib.contextmanager
+    def _locked(self, init=False):
+        if not init:
+            self._open()
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def file_key(path):
+        """Key of an item loaded from file `path`, changing whenever the file is rewritten"""
+        st = os.stat(path)
+        return "{}:{}:{}".format(path, st.st_mtime_ns, st.st_size)
+
+    def _item_path(self, key):
+        return os.path.join(self.items_path, hashlib.sha1(key.encode()).hexdigest() + ".pt")
+
+    def get_or_load(self, key, load_fn):
+        """The item cached under `key`, else `load_fn()` (which is then cached)"""
+        path = self._item_path(key)
+        try:
+            item = torch.load(path, mmap=True)
+            os.utime(path)
+        except FileNotFoundError:
+            item = None
+        if item is not None:
+            with self._locked():
+                self.counters[self.HITS] += 1
+            return item
+
+        item = load_fn()
+        self._put(path, item)
+        return item
+
+    def _put(self, path, item):
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        torch.save(item, tmp_path)
+        size = os.path.getsize(tmp_path)
+        with self._locked():
+            self.counters[self.MISSES] += 1
+            if size > self.max_bytes or os.path.exists(path):
+                os.remove(tmp_path)
+                return
+            if self.counters[self.BYTES] + size > self.max_bytes:
+                self._evict(self.low_watermark * self.max_bytes - size)
+            os.replace(tmp_path, path)
+            self.counters[self.BYTES] += size
+
+    def _evict(self, target_bytes):
+        """Remove least recently used items until at most `target_bytes` are in use. Caller holds the lock."""
+        entries = [e for e in os.scandir(self.items_path) if e.name.endswith(".pt")]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for e in entries:
+            if self.counters[self.BYTES] <= target_bytes:
+                break
+            size = e.stat().st_size
+            os.remove(e.path)
+            self.counters[self.BYTES] -= size
+            self.counters[self.EVICTIONS] += 1
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ("lock_file", "counters"):
+            state.pop(k, None)
+        state["pid"] = None
+        return state
+
+    def reset_stats(self):
+        """Zeroes the hit, miss and eviction counters; the byte count still describes the cached items"""
+        with self._locked():
+            self.counters[[self.HITS, self.MISSES, self.EVICTIONS]] = 0
+
+    def stats(self):
+        self._open()
+        hits, misses, evictions, nbytes = (int(x) for x in self.counters)
+        return {"hits": hits, "misses": misses, "evictions": evictions, "bytes": nbytes,
+                "hit_rate": hits / max(hits + misses, 1)}
+
+
+class DurationStore():
+    """ MAS durations of training utterances, keyed by manifest index.
+
+    Each entry is one int16 array holding the number of frames aligned to every
+    text token, stamped with the epoch it was computed in. A rank saves the entries
+    it computed itself to `<root>/rank{rank}.npz` as one arena plus offsets (like
+    `Manifest`), and `load` merges the files of all ranks keeping the newest entry
+    per index, so the store survives restarts and changes of world size.
+    """
+    def __init__(self, root, rank=0):
+        self.root = root
+        self.rank = rank
+        self.entries = {}
+        self.own = set()
+
+    def get(self, index):
+        entry = self.entries.get(index)
+        return None if entry is None else entry[1]
+
+    def item(self, index):
+        """(durations, index) fields appended to a dataset item; durations are empty when unknown"""
+        durations = self.get(index)
+        durations = torch.zeros(0, dtype=torch.int16) if durations is None else torch.from_numpy(durations)
+        return durations, torch.LongTensor([index])
+
+    def update(self, indices, durations, lengths, epoch):
+        """Store rows of durations [b, t_s] trimmed to lengths [b] under manifest indices [b]"""
+        for index, row, n in zip(indices.tolist(), durations, lengths.tolist()):
+            self.entries[index] = (epoch, row[:n].astype(np.int16))
+            self.own.add(index)
+
+    def save(self):
+        indices = sorted(self.own)
+        rows = [self.entries[i][1] for i in indices]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(r) for r in rows], out=offsets[1:])
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, "rank{}.npz".format(self.rank))
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, indices=np.asarray(indices, dtype=np.int64), offsets=offsets,
+                     epochs=np.asarray([self.entries[i][0] for i in indices], dtype=np.int32),
+                     arena=np.concatenate(rows) if rows else np.zeros(0, dtype=np.int16))
+        os.replace(path + ".tmp", path)
+
+    def load(self):
+        if not os.path.isdir(self.root):
+            return self
+        for name in sorted(os.listdir(self.root)):
+            if not (name.startswith("rank") and name.endswith(".npz")):
+                continue
+            own = name == "rank{}.npz".format(self.rank)
+            with np.load(os.path.join(self.root, name)) as f:
+                indices, offsets, epochs, arena = f["indices"], f["offsets"], f["epochs"], f["arena"]
+            for i, index in enumerate(indices.tolist()):
+                if index not in self.entries or epochs[i] >= self.entries[index][0]:
+                    self.entries[index] = (int(epochs[i]), arena[offsets[i]:offsets[i + 1]])
+                if own:
+                    self.own.add(index)
+        return self
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class TextAudioLoader(torch.utils.data.Dataset):
     """
         1) loads audio, text pairs
@@ -28,6 +272,9 @@ class TextAudioLoader(torch.utils.data.Dataset):
         self.sampling_rate  = hparams.sampling_rate 
 
         self.cleaned_text = getattr(hparams, "cleaned_text", False)
+        self.int16_audio = getattr(hparams, "int16_audio", False)
+        self.cache = SharedItemCache.from_hparams(hparams)
+        self.durations = None # DurationStore, attached by the training script
 
         self.add_blank = hparams.add_blank
         self.min_text_len = getattr(hparams, "min_text_len", 1)
@@ -50,28 +297,36 @@ class TextAudioLoader(torch.utils.data.Dataset):
                 if os.path.exists(audiopath) and os.path.getsize(audiopath) > self.hop_length * 2: # Check if file is long enough for at least one frame
                     audiopaths_and_text_new.append([audiopath, text])
                     lengths.append(os.path.getsize(audiopath) // (2 * self.hop_length))
-        self.audiopaths_and_text = audiopaths_and_text_new
-        self.lengths = lengths
+        self.audiopaths_and_text = Manifest(audiopaths_and_text_new, 2)
+        self.lengths = np.asarray(lengths, dtype=np.int32)
 
     def get_audio_text_pair(self, audiopath_and_text):
         audiopath, text = audiopath_and_text[0], audiopath_and_text[1]
         text = self.get_text(text)
-        spec, wav = self.get_audio(audiopath)
+        if self.cache is not None:
+            spec, wav = self.cache.get_or_load(SharedItemCache.file_key(audiopath), lambda: self.get_audio(audiopath))
+        else:
+            spec, wav = self.get_audio(audiopath)
         return (text, spec, wav)
 
     def get_audio(self, filename):
-        audio, sampling_rate = load_wav_to_torch(filename)
+        if self.int16_audio:
+            audio, sampling_rate = load_wav_to_torch_int16(filename)
+        else:
+            audio, sampling_rate = load_wav_to_torch(filename)
         if sampling_rate != self.sampling_rate:
             raise ValueError("{} {} SR doesn't match target {} SR".format(
                 sampling_rate, self.sampling_rate))
-        audio_norm = audio / self.max_wav_value
-        audio_norm = audio_norm.unsqueeze(0)
+        audio = audio.unsqueeze(0)
+        # int16 audio is normalized by max_wav_value on the device, after collate
+        wav = audio if self.int16_audio else audio / self.max_wav_value
         spec_filename = filename.replace(".wav", ".spec.pt")
         
         # --- FIX: ADD CHECK BEFORE LOADING/GENERATING SPECTROGRAM ---
         if os.path.exists(spec_filename):
             spec = torch.load(spec_filename)
         else:
+            audio_norm = audio / self.max_wav_value
             spec = spectrogram_torch(audio_norm, self.filter_length,
                 self.sampling_rate, self.hop_length, self.win_length,
                 center=False)
@@ -84,7 +339,7 @@ class TextAudioLoader(torch.utils.data.Dataset):
             print(f"Spectrogram size: {spec.size()}")
             raise ValueError(f"Skipping malformed spectrogram for file: {filename}")
 
-        return spec, audio_norm
+        return spec, wav
 
     def get_text(self, text):
         if self.cleaned_text:
@@ -97,7 +352,10 @@ class TextAudioLoader(torch.utils.data.Dataset):
         return text_norm
 
     def __getitem__(self, index):
-        return self.get_audio_text_pair(self.audiopaths_and_text[index])
+        item = self.get_audio_text_pair(self.audiopaths_and_text[index])
+        if self.durations is not None:
+            item = item + self.durations.item(index)
+        return item
 
     def __len__(self):
         return len(self.audiopaths_and_text)
@@ -105,12 +363,54 @@ class TextAudioLoader(torch.utils.data.Dataset):
 # The rest of the classes (TextAudioCollate, TextAudioSpeakerLoader, etc.) remain unchanged.
 
 
+class _BatchBuffers():
+    """ Ring of reusable flat output buffers for one collate process.
+
+    Buffers are handed out in rotation so that a batch is not overwritten while
+    up to `num_buffers - 1` newer batches are in flight (DataLoader prefetch and
+    the pin-memory thread). Allocation is lazy, so each DataLoader worker builds
+    its own ring after the fork.
+    """
+    def __init__(self, num_buffers=4, pin_memory=False):
+        self.num_buffers = num_buffers
+        self.pin_memory = pin_memory
+        self.slot = 0
+        self.pid = None
+        self.buffers = {}
+
+    def advance(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.buffers = {}
+        self.slot = (self.slot + 1) % self.num_buffers
+
+    def get(self, name, shape, dtype, capacity=0):
+        numel = int(np.prod(shape))
+        key = (self.slot, name)
+        buf = self.buffers.get(key)
+        if buf is None or buf.numel() < numel or buf.dtype != dtype:
+            buf = torch.empty(max(numel, capacity), dtype=dtype)
+            # Workers can't pin (no CUDA context after fork); the DataLoader pins for them.
+            if self.pin_memory and torch.cuda.is_available() and torch.utils.data.get_worker_info() is None:
+                buf = buf.pin_memory()
+            self.buffers[key] = buf
+        return buf[:numel].view(shape)
+
+
 class TextAudioCollate():
     """ Zero-pads model inputs and targets with configurable padding multiple
+
+    With `reuse_buffers=True` the padded outputs are views into a per-process ring
+    of preallocated buffers instead of fresh zeroed tensors. `max_spec_len` is a
+    hint (e.g. the last bucket boundary) used to size the buffers once up front.
     """
-    def __init__(self, return_ids=False, pad_multiple=8):
+    def __init__(self, return_ids=False, pad_multiple=8, reuse_buffers=False, num_buffers=4, pin_memory=False, max_spec_len=None,
+                 return_durations=False):
         self.return_ids = return_ids
+        self.return_durations = return_durations
         self.pad_multiple = pad_multiple
+        self.max_spec_len = max_spec_len
+        self.buffers = _BatchBuffers(num_buffers, pin_memory) if reuse_buffers else None
 
     def pad_to_multiple(self, x, multiple):
         """Pad length to multiple"""
@@ -118,59 +418,74 @@ class TextAudioCollate():
             x = x + multiple - (x % multiple)
         return x
 
-    def __call__(self, batch):
-        """Collate's training batch from normalized text and audio"""
+    def _padded(self, name, shape, dtype, scale=1.):
+        if self.buffers is None:
+            return torch.zeros(shape, dtype=dtype)
+        return self.buffers.get(name, shape, dtype, capacity=int(np.prod(shape) * scale))
+
+    def _fill(self, out, seqs, lengths):
+        """Copy each sequence into its row of `out`; reused buffers also need their tail zeroed"""
+        reused = self.buffers is not None
+        for row, seq, n in zip(out, seqs, lengths):
+            row[..., :n].copy_(seq)
+            if reused:
+                row[..., n:].zero_()
+        return out
+
+    def collate(self, batch):
+        """Pads text, spec and wav of `batch` sorted by decreasing spec length"""
         if len(batch) == 0:
             raise ValueError("Received empty batch")
+        texts, specs, wavs = [x[0] for x in batch], [x[1] for x in batch], [x[2] for x in batch]
+        if specs[0].dim() != 2 or wavs[0].dim() != 2:
+            raise ValueError(f"Spectrogram and waveform must be 2D, got shapes {specs[0].size()} and {wavs[0].size()}")
+
+        spec_lengths, ids_sorted_decreasing = torch.sort(
+            torch.LongTensor([x.size(1) for x in specs]), dim=0, descending=True)
+        if spec_lengths[-1] < 1:
+            raise ValueError("Received empty spectrogram in batch")
+        ids = ids_sorted_decreasing.tolist()
+        text_lengths = torch.LongTensor([texts[i].size(0) for i in ids])
+        wav_lengths = torch.LongTensor([wavs[i].size(1) for i in ids])
+
+        b = len(batch)
+        max_text_len = self.pad_to_multiple(int(text_lengths.max()), self.pad_multiple)
+        max_spec_len = self.pad_to_multiple(int(spec_lengths[0]), self.pad_multiple)
+        max_wav_len = self.pad_to_multiple(int(wav_lengths.max()), self.pad_multiple)
+        scale = max(1., (self.max_spec_len or 0) / max_spec_len)
+
+        if self.buffers is not None:
+            self.buffers.advance()
+        text_padded = self._padded("text", (b, max_text_len), torch.long, scale)
+        spec_padded = self._padded("spec", (b, specs[0].size(0), max_spec_len), specs[0].dtype, scale)
+        wav_padded = self._padded("wav", (b, 1, max_wav_len), wavs[0].dtype, scale)
+
+        self._fill(text_padded, [texts[i] for i in ids], text_lengths.tolist())
+        self._fill(spec_padded, [specs[i] for i in ids], spec_lengths.tolist())
+        self._fill(wav_padded, [wavs[i] for i in ids], wav_lengths.tolist())
+        return text_padded, text_lengths, spec_padded, spec_lengths, wav_padded, wav_lengths, ids_sorted_decreasing
+
+    def collate_durations(self, batch, ids_sorted_decreasing, max_text_len):
+        """Pads the stored durations of `batch` (the trailing durations and manifest index
+        fields added by a DurationStore). Rows without stored durations stay zero and are
+        marked in `known`."""
+        ids = ids_sorted_decreasing.tolist()
+        durations = [batch[i][-2] for i in ids]
+        known = torch.BoolTensor([d.numel() > 0 for d in durations])
+        dur_padded = torch.zeros(len(batch), max_text_len, dtype=torch.int16)
+        self._fill(dur_padded, durations, [d.numel() for d in durations])
+        index = torch.cat([batch[i][-1] for i in ids])
+        return dur_padded, known, index
 
-        # Verify batch items
-        for i, x in enumerate(batch):
-            if not isinstance(x, (list, tuple)) or len(x) != 3:  # text, spec, wav
-                raise ValueError(f"Invalid batch item at index {i}: {x}")
-            if not all(isinstance(t, torch.Tensor) for t in x):
-                raise ValueError(f"All items must be tensors at index {i}")
-
-        # Get lengths with padding
-        max_text_len = self.pad_to_multiple(max(len(x[0]) for x in batch), self.pad_multiple)
-        max_spec_len = self.pad_to_multiple(max(x[1].size(1) for x in batch), self.pad_multiple)
-        max_wav_len = self.pad_to_multiple(max(x[2].size(1) for x in batch), self.pad_multiple)
-
-        # Sort by spec length for packing
-        spec_lengths = torch.LongTensor([x[1].size(1) for x in batch])
-        spec_length_ids = torch.argsort(spec_lengths, descending=True)
-
-        # Initialize tensors
-        text_lengths = torch.LongTensor(len(batch))
-        spec_lengths = torch.LongTensor(len(batch))
-        wav_lengths = torch.LongTensor(len(batch))
-
-        text_padded = torch.LongTensor(len(batch), max_text_len).zero_()
-        spec_padded = torch.FloatTensor(len(batch), batch[0][1].size(0), max_spec_len).zero_()
-        wav_padded = torch.FloatTensor(len(batch), 1, max_wav_len).zero_()
-
-        # Fill padded tensors
-        for i, idx in enumerate(spec_length_ids):
-            row = batch[idx]
-
-            text = row[0]
-            text_padded[i, :text.size(0)] = text
-            text_lengths[i] = text.size(0)
-
-            spec = row[1]
-            if spec.dim() != 2:
-                raise ValueError(f"Spectrogram must be 2D, got shape {spec.size()}")
-            spec_padded[i, :, :spec.size(1)] = spec
-            spec_lengths[i] = spec.size(1)
-
-            wav = row[2]
-            if wav.dim() != 2:
-                raise ValueError(f"Waveform must be 2D, got shape {wav.size()}")
-            wav_padded[i, :, :wav.size(1)] = wav
-            wav_lengths[i] = wav.size(1)
-
+    def __call__(self, batch):
+        """Collate's training batch from normalized text and audio"""
+        text_padded, text_lengths, spec_padded, spec_lengths, wav_padded, wav_lengths, ids_sorted_decreasing = self.collate(batch)
+        outputs = (text_padded, text_lengths, spec_padded, spec_lengths, wav_padded, wav_lengths)
+        if self.return_durations:
+            outputs += self.collate_durations(batch, ids_sorted_decreasing, text_padded.size(1))
         if self.return_ids:
-            return text_padded, text_lengths, spec_padded, spec_lengths, wav_padded, wav_lengths, spec_length_ids
-        return text_padded, text_lengths, spec_padded, spec_lengths, wav_padded, wav_lengths
+            outputs += (ids_sorted_decreasing,)
+        return outputs
 
 """Multi speaker version"""
 class TextAudioSpeakerLoader(torch.utils.data.Dataset):
@@ -190,6 +505,9 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
         self.sampling_rate  = hparams.sampling_rate
 
         self.cleaned_text = getattr(hparams, "cleaned_text", False)
+        self.int16_audio = getattr(hparams, "int16_audio", False)
+        self.cache = SharedItemCache.from_hparams(hparams)
+        self.durations = None # DurationStore, attached by the training script
 
         self.add_blank = hparams.add_blank
         self.min_text_len = getattr(hparams, "min_text_len", 1)
@@ -213,34 +531,42 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
             if self.min_text_len <= len(text) and len(text) <= self.max_text_len:
                 audiopaths_sid_text_new.append([audiopath, sid, text])
                 lengths.append(os.path.getsize(audiopath) // (2 * self.hop_length))
-        self.audiopaths_sid_text = audiopaths_sid_text_new
-        self.lengths = lengths
+        self.audiopaths_sid_text = Manifest(audiopaths_sid_text_new, 3, int_columns=(1,))
+        self.lengths = np.asarray(lengths, dtype=np.int32)
 
     def get_audio_text_speaker_pair(self, audiopath_sid_text):
         # separate filename, speaker_id and text
         audiopath, sid, text = audiopath_sid_text[0], audiopath_sid_text[1], audiopath_sid_text[2]
         text = self.get_text(text)
-        spec, wav = self.get_audio(audiopath)
+        if self.cache is not None:
+            spec, wav = self.cache.get_or_load(SharedItemCache.file_key(audiopath), lambda: self.get_audio(audiopath))
+        else:
+            spec, wav = self.get_audio(audiopath)
         sid = self.get_sid(sid)
         return (text, spec, wav, sid)
 
     def get_audio(self, filename):
-        audio, sampling_rate = load_wav_to_torch(filename)
+        if self.int16_audio:
+            audio, sampling_rate = load_wav_to_torch_int16(filename)
+        else:
+            audio, sampling_rate = load_wav_to_torch(filename)
         if sampling_rate != self.sampling_rate:
             raise ValueError("{} {} SR doesn't match target {} SR".format(
                 sampling_rate, self.sampling_rate))
-        audio_norm = audio / self.max_wav_value
-        audio_norm = audio_norm.unsqueeze(0)
+        audio = audio.unsqueeze(0)
+        # int16 audio is normalized by max_wav_value on the device, after collate
+        wav = audio if self.int16_audio else audio / self.max_wav_value
         spec_filename = filename.replace(".wav", ".spec.pt")
         if os.path.exists(spec_filename):
             spec = torch.load(spec_filename)
         else:
+            audio_norm = audio / self.max_wav_value
             spec = spectrogram_torch(audio_norm, self.filter_length,
                 self.sampling_rate, self.hop_length, self.win_length,
                 center=False)
             spec = torch.squeeze(spec, 0)
             torch.save(spec, spec_filename)
-        return spec, audio_norm
+        return spec, wav
 
     def get_text(self, text):
         if self.cleaned_text:
@@ -257,98 +583,106 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
         return sid
 
     def __getitem__(self, index):
-        # --- DEBUG: ADD PRINT STATEMENT HERE ---
-        try:
-            item = self.get_audio_text_speaker_pair(self.audiopaths_sid_text[index])
-            print(f"TextAudioSpeakerLoader: Processing index {index}. Item length: {len(item)}")
-            return item
-        except IndexError as e:
-            print(f"TextAudioSpeakerLoader: IndexError at index {index}. Original error: {e}")
-            print(f"Problematic audiopath_sid_text: {self.audiopaths_sid_text[index]}")
-            raise
-
+        item = self.get_audio_text_speaker_pair(self.audiopaths_sid_text[index])
+        if self.durations is not None:
+            item = item + self.durations.item(index)
+        return item
 
     def __len__(self):
         return len(self.audiopaths_sid_text)
 
 
-class TextAudioSpeakerCollate():
+class TextAudioSpeakerCollate(TextAudioCollate):
     """ Zero-pads model inputs and targets
     """
-    def __init__(self, return_ids=False):
-        self.return_ids = return_ids
+    def __init__(self, return_ids=False, pad_multiple=1, **kwargs):
+        super().__init__(return_ids=return_ids, pad_multiple=pad_multiple, **kwargs)
 
     def __call__(self, batch):
         """Collate's training batch from normalized text, audio and speaker identities
         PARAMS
         ------
-        batch: [text_normalized, spec_normalized, wav_normalized, sid]
+        batch: [text_normalized, spec_normalized, wav_normalized, sid(, durations, index)]
         """
-        # --- DEBUG: ADD PRINT STATEMENTS HERE ---
-        print("\n--- TextAudioSpeakerCollate.__call__ DEBUG ---")
-        print(f"Batch size: {len(batch)}")
-        if len(batch) > 0:
-            first_item = batch[0]
-            print(f"First item in batch is of type: {type(first_item)}")
-            print(f"First item in batch length: {len(first_item)}")
-            for i, x in enumerate(first_item):
-                if isinstance(x, torch.Tensor):
-                    print(f"  Item {i} is a tensor with size: {x.size()}")
-                else:
-                    print(f"  Item {i} is not a tensor, its type is: {type(x)}")
-        
-        # Check for malformed items in the batch
-        for i, x in enumerate(batch):
-            if not isinstance(x, (list, tuple)) or len(x) < 2:
-                print(f"ERROR: Malformed item found at batch index {i}. Item: {x}")
-                raise ValueError("Malformed batch item detected. Check your data and `__getitem__` method.")
-
-        try:
-            # Right zero-pad all one-hot text sequences to max input length
-            _, ids_sorted_decreasing = torch.sort(
-                torch.LongTensor([x[1].size(1) for x in batch]),
-                dim=0, descending=True)
-        except IndexError as e:
-            print("ERROR: IndexError occurred during torch.sort in TextAudioSpeakerCollate.")
-            print("This usually means one of the items in the batch (x[1]) is not a 2D tensor or has an unexpected shape.")
-            print(f"Original Error: {e}")
-            raise
-
-        max_text_len = max([len(x[0]) for x in batch])
-        max_spec_len = max([x[1].size(1) for x in batch])
-        max_wav_len = max([x[2].size(1) for x in batch])
-
-        text_lengths = torch.LongTensor(len(batch))
-        spec_lengths = torch.LongTensor(len(batch))
-        wav_lengths = torch.LongTensor(len(batch))
-        sid = torch.LongTensor(len(batch))
-
-        text_padded = torch.LongTensor(len(batch), max_text_len)
-        spec_padded = torch.FloatTensor(len(batch), batch[0][1].size(0), max_spec_len)
-        wav_padded = torch.FloatTensor(len(batch), 1, max_wav_len)
-        text_padded.zero_()
-        spec_padded.zero_()
-        wav_padded.zero_()
-        for i in range(len(ids_sorted_decreasing)):
-            row = batch[ids_sorted_decreasing[i]]
-
-            text = row[0]
-            text_padded[i, :text.size(0)] = text
-            text_lengths[i] = text.size(0)
-
-            spec = row[1]
-            spec_padded[i, :, :spec.size(1)] = spec
-            spec_lengths[i] = spec.size(1)
-
-            wav = row[2]
-            wav_padded[i, :, :wav.size(1)] = wav
-            wav_lengths[i] = wav.size(1)
-
-            sid[i] = row[3]
+        text_padded, text_lengths, spec_padded, spec_lengths, wav_padded, wav_lengths, ids_sorted_decreasing = self.collate(batch)
+        sid = torch.cat([x[3] for x in batch])[ids_sorted_decreasing]
 
+        outputs = (text_padded, text_lengths, spec_padded, spec_lengths, wav_padded, wav_lengths, sid)
+        if self.return_durations:
+            outputs += self.collate_durations(batch, ids_sorted_decreasing, text_padded.size(1))
         if self.return_ids:
-            return text_padded, text_lengths, spec_padded, spec_lengths, wav_padded, wav_lengths, sid, ids_sorted_decreasing
-        return text_padded, text_lengths, spec_padded, spec_lengths, wav_padded, wav_lengths, sid
+            outputs += (ids_sorted_decreasing,)
+        return outputs
+
+
+class LatentAudioLoader(torch.utils.data.Dataset):
+    """ Posterior latent segments with the matching spectrogram and audio, for decoder-only fine-tuning.
+
+    Wraps a TextAudioLoader / TextAudioSpeakerLoader whose posterior statistics under a
+    frozen enc_q (m_q and logs_q stacked, float16 [2 * inter_channels, t]) are cached as
+    `<root>/<manifest index>.pt`. Each item draws a random window of `segment_frames`,
+    samples z = m_q + eps * exp(logs_q) in it and returns (z, spec, wav[, sid]) for that
+    window, zero-padded past the end of short utterances like the masked posterior.
+    """
+    def __init__(self, dataset, root, segment_frames, hop_length):
+        self.dataset = dataset
+        self.root = root
+        self.segment_frames = segment_frames
+        self.hop_length = hop_length
+
+    def latent_path(self, index):
+        return os.path.join(self.root, "{}.pt".format(index))
+
+    def _window(self, x, start, size):
+        out = x.new_zeros(x.size(0), size)
+        x = x[:, start:start + size]
+        out[:, :x.size(1)] = x
+        return out
+
+    def __getitem__(self, index):
+        item = self.dataset[index]
+        spec, wav = item[1], item[2]
+        m, logs = torch.load(self.latent_path(index)).float().chunk(2, 0)
+        start = random.randint(0, max(m.size(1) - self.segment_frames, 0))
+        m = m[:, start:start + self.segment_frames]
+        logs = logs[:, start:start + self.segment_frames]
+        z = self._window(m + torch.randn_like(m) * torch.exp(logs), 0, self.segment_frames)
+        spec = self._window(spec, start, self.segment_frames)
+        wav = self._window(wav, start * self.hop_length, self.segment_frames * self.hop_length)
+        return (z, spec, wav) + tuple(item[3:])
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def length_boundaries(lengths, num_buckets=10):
+    """Bucket boundaries at equal-count quantiles of the length histogram.
+
+    The first boundary sits just below the shortest sample and the last one at the
+    longest, so every sample falls into a bucket.
+    """
+    lengths = np.asarray(lengths)
+    quantiles = np.quantile(lengths, np.linspace(0, 1, num_buckets + 1)[1:])
+    boundaries = np.unique(np.ceil(quantiles).astype(np.int64))
+    return [int(lengths.min()) - 1] + boundaries.tolist()
+
+
+class ResumableDistributedSampler(torch.utils.data.distributed.DistributedSampler):
+    """DistributedSampler over fixed-size batches whose next epoch can start at a later batch"""
+    def __init__(self, dataset, batch_size, num_replicas=None, rank=None, shuffle=True):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle)
+        self.batch_size = batch_size
+        self.start_batch = 0
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        # a mid-epoch resume skips the batches already trained on, for this epoch only
+        start_batch, self.start_batch = self.start_batch, 0
+        return iter(indices[start_batch * self.batch_size:])
+
+    def set_start_batch(self, start_batch):
+        """Start the next epoch at batch `start_batch`; the index order depends only on the epoch"""
+        self.start_batch = start_batch
 
 
 class DistributedBucketSampler(torch.utils.data.distributed.DistributedSampler):
@@ -359,92 +693,119 @@ class DistributedBucketSampler(torch.utils.data.distributed.DistributedSampler):
   
     It removes samples which are not included in the boundaries.
     Ex) boundaries = [b1, b2, b3] -> any x s.t. length(x) <= b1 or length(x) > b3 are discarded.
+
+    If boundaries is None, `num_buckets` boundaries are derived from the length histogram (see `length_boundaries`).
+
+    If max_frames is given, batch_size is ignored and each bucket gets the largest batch size whose
+    padded cost, batch_size * max_length ** frames_power, stays within max_frames on every rank
+    (frames_power=2 budgets frames² for attention-like memory), capped at max_batch_size.
     """
-    def __init__(self, dataset, batch_size, boundaries, num_replicas=None, rank=None, shuffle=True):
+    def __init__(self, dataset, batch_size, boundaries=None, num_replicas=None, rank=None, shuffle=True,
+                 max_frames=None, frames_power=1, max_batch_size=None, num_buckets=10):
         super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle)
-        self.lengths = dataset.lengths
+        self.lengths = np.asarray(dataset.lengths, dtype=np.int64)
         self.batch_size = batch_size
-        self.boundaries = boundaries
+        self.max_frames = max_frames
+        self.frames_power = frames_power
+        self.max_batch_size = max_batch_size
+        if boundaries is None:
+            boundaries = length_boundaries(self.lengths, num_buckets)
+        self.boundaries = list(boundaries)
   
-        self.buckets, self.num_samples_per_bucket = self._create_buckets()
+        self.buckets = self._create_buckets()
+        self.batch_sizes, self.num_samples_per_bucket = self._bucket_batch_sizes()
         self.total_size = sum(self.num_samples_per_bucket)
         self.num_samples = self.total_size // self.num_replicas
+        self.num_batches = sum(n // (self.num_replicas * bs) for n, bs in zip(self.num_samples_per_bucket, self.batch_sizes))
+        self.frame_stats = {}
+        self.start_batch = 0
   
     def _create_buckets(self):
-        buckets = [[] for _ in range(len(self.boundaries) - 1)]
-        for i in range(len(self.lengths)):
-            length = self.lengths[i]
-            idx_bucket = self._bisect(length)
-            if idx_bucket != -1:
-                buckets[idx_bucket].append(i)
+        idx_bucket = np.searchsorted(self.boundaries, self.lengths, side='left') - 1
+        valid = (idx_bucket >= 0) & (idx_bucket < len(self.boundaries) - 1)
+        self.num_dropped = int((~valid).sum())
+        if self.num_dropped > 0 and self.rank == 0:
+            print(f"WARNING: DistributedBucketSampler drops {self.num_dropped} samples outside boundaries {self.boundaries}")
+
+        ids = np.nonzero(valid)[0]
+        ids = ids[np.argsort(idx_bucket[ids], kind='stable')]
+        counts = np.bincount(idx_bucket[valid], minlength=len(self.boundaries) - 1)
+        buckets = np.split(ids, np.cumsum(counts)[:-1])
   
-        for i in range(len(buckets) - 1, 0, -1):
+        for i in range(len(buckets) - 1, -1, -1):
             if len(buckets[i]) == 0:
                 buckets.pop(i)
                 self.boundaries.pop(i+1)
-  
+        return buckets
+
+    def _bucket_batch_sizes(self):
+        if self.max_frames is None:
+            batch_sizes = [self.batch_size] * len(self.buckets)
+        else:
+            batch_sizes = []
+            for bucket in self.buckets:
+                bs = int(self.max_frames // float(self.lengths[bucket].max()) ** self.frames_power)
+                batch_sizes.append(max(1, min(bs, self.max_batch_size or bs)))
+
         num_samples_per_bucket = []
-        for i in range(len(buckets)):
-            len_bucket = len(buckets[i])
-            total_batch_size = self.num_replicas * self.batch_size
+        for bucket, bs in zip(self.buckets, batch_sizes):
+            len_bucket = len(bucket)
+            total_batch_size = self.num_replicas * bs
             rem = (total_batch_size - (len_bucket % total_batch_size)) % total_batch_size
             num_samples_per_bucket.append(len_bucket + rem)
-        return buckets, num_samples_per_bucket
+        return batch_sizes, num_samples_per_bucket
   
     def __iter__(self):
       # deterministically shuffle based on epoch
       g = torch.Generator()
       g.manual_seed(self.epoch)
   
-      indices = []
       if self.shuffle:
-          for bucket in self.buckets:
-              indices.append(torch.randperm(len(bucket), generator=g).tolist())
+          indices = [torch.randperm(len(bucket), generator=g).numpy() for bucket in self.buckets]
       else:
-          for bucket in self.buckets:
-              indices.append(list(range(len(bucket))))
+          indices = [np.arange(len(bucket)) for bucket in self.buckets]
   
       batches = []
+      real_frames, padded_frames = 0, 0
       for i in range(len(self.buckets)):
           bucket = self.buckets[i]
           len_bucket = len(bucket)
           ids_bucket = indices[i]
           num_samples_bucket = self.num_samples_per_bucket[i]
+          batch_size = self.batch_sizes[i]
   
           # add extra samples to make it evenly divisible
           rem = num_samples_bucket - len_bucket
-          ids_bucket = ids_bucket + ids_bucket * (rem // len_bucket) + ids_bucket[:(rem % len_bucket)]
+          ids_bucket = np.concatenate([ids_bucket] * (1 + rem // len_bucket) + [ids_bucket[:(rem % len_bucket)]])
   
           # subsample
           ids_bucket = ids_bucket[self.rank::self.num_replicas]
   
           # batching
-          for j in range(len(ids_bucket) // self.batch_size):
-              batch = [bucket[idx] for idx in ids_bucket[j*self.batch_size:(j+1)*self.batch_size]]
-              batches.append(batch)
+          num_batches = len(ids_bucket) // batch_size
+          bucket_batches = bucket[ids_bucket[:num_batches * batch_size]].reshape(num_batches, batch_size)
+          batch_lengths = self.lengths[bucket_batches]
+          real_frames += int(batch_lengths.sum())
+          padded_frames += int(batch_lengths.max(1).sum()) * batch_size
+          batches.extend(bucket_batches.tolist())
   
       if self.shuffle:
           batch_ids = torch.randperm(len(batches), generator=g).tolist()
           batches = [batches[i] for i in batch_ids]
       self.batches = batches
+      self.frame_stats = {
+          "real_frames": real_frames,
+          "padded_frames": padded_frames,
+          "padding_ratio": padded_frames / max(real_frames, 1)}
   
-      assert len(self.batches) * self.batch_size == self.num_samples
-      return iter(self.batches)
-  
-    def _bisect(self, x, lo=0, hi=None):
-      if hi is None:
-          hi = len(self.boundaries) - 1
-  
-      if hi > lo:
-          mid = (hi + lo) // 2
-          if self.boundaries[mid] < x and x <= self.boundaries[mid+1]:
-              return mid
-          elif x <= self.boundaries[mid]:
-              return self._bisect(x, lo, mid)
-          else:
-              return self._bisect(x, mid + 1, hi)
-      else:
-          return -1
+      assert len(self.batches) == self.num_batches
+      # a mid-epoch resume skips the batches already trained on, for this epoch only
+      start_batch, self.start_batch = self.start_batch, 0
+      return iter(self.batches[start_batch:])
+
+    def set_start_batch(self, start_batch):
+        """Start the next epoch at batch `start_batch`; the batch order depends only on the epoch"""
+        self.start_batch = start_batch
 
     def __len__(self):
-        return self.num_samples // self.batch_size
\ No newline at end of file
+        return self.num_batches
@@ -0,0 +1,335 @@
+import os
+import time
+import torch
+from torch.nn import functional as F
+from torch.utils.data import DataLoader
+from torch.utils.tensorboard import SummaryWriter
+import torch.multiprocessing as mp
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+import commons
+import utils
+from data_utils import (
+  TextAudioLoader,
+  TextAudioSpeakerLoader,
+  LatentAudioLoader,
+  ResumableDistributedSampler
+)
+from models import (
+  SynthesizerTrn,
+  MultiPeriodDiscriminator,
+)
+from losses import (
+  generator_loss,
+  discriminator_loss,
+  feature_loss,
+  SubbandSTFTLoss
+)
+from mel_processing import MelSpectrogram
+from text.symbols import symbols
+
+torch.backends.cudnn.benchmark = True
+global_step = 0
+
+
+def main():
+  """Decoder-only fine-tuning (vocoder adaptation) from cached posterior latents.
+
+  Starts from the latest G_*.pth / D_*.pth pair in the model directory (copy the pretrained
+  checkpoints there; without them it stops), caches m_q / logs_q of every training utterance under the frozen
+  enc_q once, and then trains only `dec` against the discriminators: enc_p, enc_q, flow,
+  MAS and the duration predictor never run. Checkpoints hold the full generator.
+  """
+  os.environ['MASTER_ADDR'] = 'localhost'
+  os.environ['MASTER_PORT'] = '65520'
+
+  hps = utils.get_hparams()
+  if utils.get_device_type(hps) == "cuda":
+    n_procs = torch.cuda.device_count()
+  else:
+    n_procs = getattr(hps.train, "num_processes", 1)
+  mp.spawn(run, nprocs=n_procs, args=(n_procs, hps,))
+
+
+def cache_latents(rank, n_procs, net_g, dataset, device):
+  """Writes the posterior statistics of every utterance of `dataset.dataset` that is not cached yet"""
+  os.makedirs(dataset.root, exist_ok=True)
+  net_g.eval()
+  with torch.no_grad():
+    for index in range(rank, len(dataset), n_procs):
+      path = dataset.latent_path(index)
+      if os.path.exists(path):
+        continue
+      item = dataset.dataset[index]
+      spec = item[1].unsqueeze(0).to(device)
+      g = net_g.emb_g(item[3].to(device)).unsqueeze(-1) if net_g.n_speakers > 0 else None
+      _, m_q, logs_q, _ = net_g.enc_q(spec, torch.LongTensor([spec.size(2)]).to(device), g=g)
+      torch.save(torch.cat([m_q, logs_q], 1)[0].half().cpu(), path + ".tmp")
+      os.replace(path + ".tmp", path)
+  net_g.train()
+  dist.barrier()
+
+
+def run(rank, n_procs, hps):
+  global global_step
+  if rank == 0:
+    logger = utils.get_logger(hps.model_dir)
+    logger.info(hps)
+    utils.check_git_hash(hps.model_dir)
+    # plots are rendered and summaries written off the training thread
+    writer = utils.SummaryWorker(SummaryWriter(log_dir=hps.model_dir))
+    writer_eval = utils.SummaryWorker(SummaryWriter(log_dir=os.path.join(hps.model_dir, "eval")))
+    checkpoint_writer = utils.CheckpointWriter.from_hparams(hps, logger)
+
+  device_type = utils.get_device_type(hps)
+  dist.init_process_group(backend='nccl' if device_type == "cuda" else 'gloo', init_method='env://', world_size=n_procs, rank=rank)
+  torch.manual_seed(hps.train.seed)
+  if device_type == "cuda":
+    torch.cuda.set_device(rank)
+    device = torch.device("cuda", rank)
+  else:
+    torch.set_num_threads(max(1, os.cpu_count() // n_procs))
+    device = torch.device("cpu")
+
+  n_speakers = getattr(hps.data, "n_speakers", 0)
+  Loader = TextAudioSpeakerLoader if n_speakers > 0 else TextAudioLoader
+  segment_frames = hps.train.segment_size // hps.data.hop_length
+  train_dataset = LatentAudioLoader(Loader(hps.data.training_files, hps.data),
+      os.path.join(hps.model_dir, "latents"), segment_frames, hps.data.hop_length)
+  # every item is one fixed-size window, so plain shuffled batches carry no padding to bucket away
+  train_sampler = ResumableDistributedSampler(train_dataset, hps.train.batch_size, num_replicas=n_procs, rank=rank, shuffle=True)
+  train_loader = DataLoader(train_dataset, num_workers=getattr(hps.train, "num_workers", 8), shuffle=False,
+      pin_memory=device.type == "cuda", batch_size=hps.train.batch_size, sampler=train_sampler, drop_last=True)
+  if rank == 0:
+    eval_dataset = Loader(hps.data.validation_files, hps.data)
+
+  net_g = SynthesizerTrn(
+      len(symbols),
+      hps.data.filter_length // 2 + 1,
+      segment_frames,
+      n_speakers=n_speakers,
+      **hps.model).to(device)
+  net_d = MultiPeriodDiscriminator(hps.model.use_spectral_norm).to(device)
+  if getattr(hps.train, "compile", False):
+    # dec and D only see fixed segment_size shapes; Module.compile keeps the parameter names of checkpoints
+    net_g.dec.compile()
+    net_d.compile()
+  # the optimizer covers the whole generator so that its checkpoints stay interchangeable
+  # with train_latest*.py; frozen parameters never get a gradient and are skipped
+  optim_g = torch.optim.AdamW(
+      net_g.parameters(),
+      hps.train.learning_rate,
+      betas=hps.train.betas,
+      eps=hps.train.eps)
+  optim_d = torch.optim.AdamW(
+      net_d.parameters(),
+      hps.train.learning_rate,
+      betas=hps.train.betas,
+      eps=hps.train.eps)
+
+  # a random enc_q would also fill the latent cache that every later run reuses, so there is no fallback
+  checkpoint_step = utils.latest_checkpoint_step(hps.model_dir)
+  if checkpoint_step is None:
+    raise FileNotFoundError("No G_*.pth / D_*.pth pair in {}: copy the pretrained checkpoints there before "
+                            "fine-tuning the decoder".format(hps.model_dir))
+  _, _, _, epoch_str = utils.load_checkpoint(os.path.join(hps.model_dir, "G_{}.pth".format(checkpoint_step)), net_g, optim_g)
+  _, _, _, epoch_str = utils.load_checkpoint(os.path.join(hps.model_dir, "D_{}.pth".format(checkpoint_step)), net_d, optim_d)
+  # continues the step numbering of the checkpoint, pretrained or saved by an earlier fine-tuning run
+  global_step = checkpoint_step + 1
+  train_state = utils.load_train_state(hps.model_dir, rank, checkpoint_step)
+  if train_state is not None: # resume right after the checkpointed step instead of at its epoch start
+    epoch_str = train_state["epoch"]
+    train_sampler.set_start_batch(train_state["batch"])
+
+  net_g.requires_grad_(False)
+  net_g.dec.requires_grad_(True)
+  cache_latents(rank, n_procs, net_g, train_dataset, device)
+
+  device_ids = [rank] if device.type == "cuda" else None
+  dec = DDP(net_g.dec, device_ids=device_ids)
+  net_d = DDP(net_d, device_ids=device_ids)
+
+  scheduler_g = torch.optim.lr_scheduler.ExponentialLR(optim_g, gamma=hps.train.lr_decay, last_epoch=epoch_str-2)
+  scheduler_d = torch.optim.lr_scheduler.ExponentialLR(optim_d, gamma=hps.train.lr_decay, last_epoch=epoch_str-2)
+
+  scaler = torch.amp.GradScaler(device.type, enabled=utils.get_autocast_dtype(hps, device.type) == torch.float16)
+  rng_state = None
+  if train_state is not None:
+    scheduler_g.load_state_dict(train_state["schedulers"][0])
+    scheduler_d.load_state_dict(train_state["schedulers"][1])
+    if train_state["scaler"]:
+      scaler.load_state_dict(train_state["scaler"])
+    rng_state = train_state["rng"]
+  mel_fn = MelSpectrogram.from_hparams(hps.data, check_range=getattr(hps.train, "check_wav_range", False)).to(device)
+  subband_loss = SubbandSTFTLoss.from_hparams(hps, timing=rank == 0).to(device) if hps.model.mb_istft_vits else None
+
+  for epoch in range(epoch_str, hps.train.epochs + 1):
+    if rank==0:
+      train_and_evaluate(rank, epoch, hps, [net_g, dec, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, [train_loader, eval_dataset], logger, [writer, writer_eval], mel_fn, subband_loss, checkpoint_writer, rng_state)
+    else:
+      train_and_evaluate(rank, epoch, hps, [net_g, dec, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, [train_loader, None], None, None, mel_fn, subband_loss, None, rng_state)
+    rng_state = None
+    scheduler_g.step()
+    scheduler_d.step()
+
+  if rank == 0:
+    checkpoint_writer.close()
+    writer.close()
+    writer_eval.close()
+
+
+def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loaders, logger, writers, mel_fn, subband_loss=None, checkpoint_writer=None, rng_state=None):
+  net_g, dec, net_d = nets
+  optim_g, optim_d = optims
+  train_loader, eval_dataset = loaders
+  if writers is not None:
+    writer, writer_eval = writers
+
+  train_loader.sampler.set_epoch(epoch)
+  global global_step
+  device = next(net_d.parameters()).device
+  amp_dtype = utils.get_autocast_dtype(hps, device.type)
+  batched_d = getattr(hps.train, "batched_discriminator", False)
+  log_start, log_steps, log_utts = time.perf_counter(), 0, 0
+
+  dec.train()
+  net_d.train()
+  start_batch = train_loader.sampler.start_batch # reset by the sampler once iterated
+  loader_iter = iter(train_loader)
+  if rng_state is not None:
+    # restored after the loader drew its worker seeds, so the resumed steps draw the same random numbers
+    utils.set_rng_state(rng_state, device)
+  for batch_idx, (z, spec, y, *speakers) in enumerate(loader_iter, start_batch):
+    z, spec, y = z.to(device, non_blocking=True), spec.to(device, non_blocking=True), y.to(device, non_blocking=True)
+    if y.dtype == torch.int16: # data.int16_audio: normalize on the device
+      y = y.float() / hps.data.max_wav_value
+    g = None
+    if net_g.n_speakers > 0:
+      with torch.no_grad():
+        g = net_g.emb_g(speakers[0].to(device, non_blocking=True).squeeze(1)).unsqueeze(-1)
+
+    with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+      y_hat, y_hat_mb = dec(z, g=g)
+      y_mel = mel_fn.spec_to_mel(spec)
+      y_hat_mel = mel_fn(y_hat.squeeze(1))
+
+      # Discriminator
+      if batched_d:
+        y_d_hat_r, y_d_hat_g, fmap_r, _ = net_d(y, y_hat.detach(), concat=True, detach_fmap=True)
+      else:
+        y_d_hat_r, y_d_hat_g, _, _ = net_d(y, y_hat.detach())
+      with torch.autocast(device.type, enabled=False):
+        loss_disc, losses_disc_r, losses_disc_g = discriminator_loss(y_d_hat_r, y_d_hat_g)
+    optim_d.zero_grad()
+    scaler.scale(loss_disc).backward()
+    scaler.unscale_(optim_d)
+    grad_norm_d = commons.clip_grad_value_(net_d.parameters(), None)
+    scaler.step(optim_d)
+
+    with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+      # Generator
+      if batched_d:
+        _, y_d_hat_g, _, fmap_g = net_d(None, y_hat)
+      else:
+        y_d_hat_r, y_d_hat_g, fmap_r, fmap_g = net_d(y, y_hat)
+      with torch.autocast(device.type, enabled=False):
+        loss_mel = F.l1_loss(y_mel, y_hat_mel) * hps.train.c_mel
+        loss_fm = feature_loss(fmap_r, fmap_g)
+        loss_gen, losses_gen = generator_loss(y_d_hat_g)
+        if subband_loss is not None:
+          loss_subband = subband_loss(y, y_hat_mb)
+        else:
+          loss_subband = torch.tensor(0.0)
+        loss_gen_all = loss_gen + loss_fm + loss_mel + loss_subband
+
+    optim_g.zero_grad()
+    scaler.scale(loss_gen_all).backward()
+    scaler.unscale_(optim_g)
+    grad_norm_g = commons.clip_grad_value_(dec.parameters(), None)
+    scaler.step(optim_g)
+    scaler.update()
+    log_steps += 1
+    log_utts += z.size(0)
+
+    if rank==0:
+      if global_step % hps.train.log_interval == 0:
+        lr = optim_g.param_groups[0]['lr']
+        losses = [loss_disc, loss_gen, loss_fm, loss_mel, loss_subband]
+        logger.info('Train Epoch: {} [{:.0f}%]'.format(
+          epoch,
+          100. * batch_idx / len(train_loader)))
+        logger.info([x.item() for x in losses] + [global_step, lr])
+        elapsed = time.perf_counter() - log_start
+        throughput = {
+          "throughput/steps_per_sec": log_steps / elapsed,
+          "throughput/utts_per_sec": log_utts / elapsed,
+          "throughput/audio_sec_per_sec": log_utts * hps.train.segment_size / hps.data.sampling_rate / elapsed}
+        logger.info('Throughput per process ({}): {}'.format(device, throughput))
+        log_start, log_steps, log_utts = time.perf_counter(), 0, 0
+
+        scalar_dict = {"loss/g/total": loss_gen_all, "loss/d/total": loss_disc, "learning_rate": lr, "grad_norm_d": grad_norm_d, "grad_norm_g": grad_norm_g}
+        scalar_dict.update(throughput)
+        scalar_dict.update(checkpoint_writer.stats())
+        scalar_dict["summary/dropped"] = writer.dropped
+        scalar_dict.update({"loss/g/fm": loss_fm, "loss/g/mel": loss_mel, "loss/g/subband": loss_subband})
+        scalar_dict.update({"loss/g/{}".format(i): v for i, v in enumerate(losses_gen)})
+        scalar_dict.update({"loss/d_r/{}".format(i): v for i, v in enumerate(losses_disc_r)})
+        scalar_dict.update({"loss/d_g/{}".format(i): v for i, v in enumerate(losses_disc_g)})
+        spectrograms = {
+            "slice/mel_org": y_mel[0].data.float().cpu().numpy(),
+            "slice/mel_gen": y_hat_mel[0].data.float().cpu().numpy(),
+        }
+        writer.summarize(
+          global_step=global_step,
+          spectrograms=spectrograms,
+          scalars=scalar_dict)
+
+      if global_step % hps.train.eval_interval == 0:
+        evaluate(hps, net_g, eval_dataset, writer_eval, mel_fn)
+        checkpoint_writer.save(net_g, optim_g, hps.train.learning_rate, epoch, os.path.join(hps.model_dir, "G_{}.pth".format(global_step)))
+        checkpoint_writer.save(net_d, optim_d, hps.train.learning_rate, epoch, os.path.join(hps.model_dir, "D_{}.pth".format(global_step)))
+    if global_step % hps.train.eval_interval == 0:
+      utils.save_train_state(hps.model_dir, rank, global_step, epoch, batch_idx + 1, scaler, schedulers, device)
+    global_step += 1
+
+  if rank == 0:
+    logger.info('====> Epoch: {}'.format(epoch))
+
+
+def evaluate(hps, generator, eval_dataset, writer_eval, mel_fn):
+    """Resynthesizes the first validation utterance from its posterior latents"""
+    device = next(generator.parameters()).device
+    generator.eval()
+    with torch.no_grad():
+      item = eval_dataset[0]
+      spec, y = item[1].unsqueeze(0).to(device), item[2].unsqueeze(0).to(device)
+      if y.dtype == torch.int16:
+        y = y.float() / hps.data.max_wav_value
+      g = generator.emb_g(item[3].to(device)).unsqueeze(-1) if generator.n_speakers > 0 else None
+      z, _, _, _ = generator.enc_q(spec, torch.LongTensor([spec.size(2)]).to(device), g=g)
+      y_hat, _ = generator.dec(z, g=g)
+
+      mel = mel_fn.spec_to_mel(spec)
+      y_hat_mel = mel_fn(y_hat.squeeze(1).float())
+    spectrograms = {
+      "gen/mel": y_hat_mel[0].cpu().numpy()
+    }
+    audio_dict = {
+      "gen/audio": y_hat[0].float().cpu()
+    }
+    if global_step == 0:
+      spectrograms.update({"gt/mel": mel[0].cpu().numpy()})
+      audio_dict.update({"gt/audio": y[0].cpu()})
+
+    writer_eval.summarize(
+      global_step=global_step,
+      spectrograms=spectrograms,
+      audios=audio_dict,
+      audio_sampling_rate=hps.data.sampling_rate
+    )
+    generator.train()
+
+
+if __name__ == "__main__":
+  main()
@@ -1,6 +1,8 @@
+import time
 import torch 
 from torch.nn import functional as F
 from stft_loss import MultiResolutionSTFTLoss
+from pqmf import PQMF
 
 
 import commons
@@ -27,8 +29,8 @@ def discriminator_loss(disc_real_outputs, disc_generated_outputs):
     r_loss = torch.mean((1-dr)**2)
     g_loss = torch.mean(dg**2)
     loss += (r_loss + g_loss)
-    r_losses.append(r_loss.item())
-    g_losses.append(g_loss.item())
+    r_losses.append(r_loss.detach())
+    g_losses.append(g_loss.detach())
 
   return loss, r_losses, g_losses
 
@@ -69,3 +71,55 @@ def subband_stft_loss(h, y_mb, y_hat_mb):
   sub_sc_loss, sub_mag_loss = sub_stft_loss(y_hat_mb[:, :y_mb.size(-1)], y_mb)
   return sub_sc_loss+sub_mag_loss
 
+
+class SubbandSTFTLoss(torch.nn.Module):
+  """Multi-resolution STFT loss between PQMF subbands of y and the generated subbands.
+
+  Built once per rank and moved to the device with the model, so the PQMF filters
+  and STFT windows stay resident. With timing=True the time spent in forward is
+  accumulated (CUDA events, no synchronization) and read back with pop_elapsed().
+  """
+  def __init__(self, fft_sizes, hop_sizes, win_lengths, window="hann_window", subbands=4, timing=False):
+    super().__init__()
+    self.pqmf = PQMF(torch.device("cpu"), subbands)
+    self.stft_loss = MultiResolutionSTFTLoss(fft_sizes, hop_sizes, win_lengths, window)
+    self.timing = timing
+    self._intervals = []
+
+  @classmethod
+  def from_hparams(cls, h, timing=False):
+    return cls(h.train.fft_sizes, h.train.hop_sizes, h.train.win_lengths,
+               getattr(h.train, "window", "hann_window"), h.model.subbands, timing)
+
+  def _now(self, device):
+    if device.type == "cuda":
+      event = torch.cuda.Event(enable_timing=True)
+      event.record()
+      return event
+    return time.perf_counter()
+
+  def forward(self, y, y_hat_mb):
+    """
+    y: [b, 1, t], y_hat_mb: [b, subbands, t // subbands]
+    """
+    if self.timing:
+      start = self._now(y.device)
+    y_mb = self.pqmf.analysis(y.float())
+    y_mb = y_mb.view(-1, y_mb.size(2))
+    y_hat_mb = y_hat_mb.float().view(-1, y_hat_mb.size(2))
+    sub_sc_loss, sub_mag_loss = self.stft_loss(y_hat_mb[:, :y_mb.size(-1)], y_mb)
+    if self.timing:
+      self._intervals.append((start, self._now(y.device)))
+    return sub_sc_loss + sub_mag_loss
+
+  def pop_elapsed(self):
+    """Seconds spent in forward since the last call"""
+    elapsed = 0.
+    for start, end in self._intervals:
+      if isinstance(start, float):
+        elapsed += end - start
+      else:
+        end.synchronize()
+        elapsed += start.elapsed_time(end) / 1000.
+    self._intervals = []
+    return elapsed
@@ -66,7 +66,7 @@ def spectrogram_torch(y, n_fft, sampling_rate, hop_size, win_size, center=False)
     spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[wnsize_dtype_device],
                       center=center, pad_mode='reflect', normalized=False, onesided=True,return_complex=True)
 
-    spec = torch.sqrt(spec.pow(2).sum(-1) + 1e-6)
+    spec = torch.sqrt(spec.real.pow(2) + spec.imag.pow(2) + 1e-6)
     if spec.dim() == 3:
         spec = spec.squeeze(0)
     if spec.dim() == 2 and spec.size(0) == 1:
@@ -123,7 +123,6 @@ def mel_spectrogram_torch(y, n_fft, num_mels, sampling_rate, hop_size, win_size,
 
     # Get magnitude from complex STFT output
     spec = torch.sqrt(spec.real.pow(2) + spec.imag.pow(2) + 1e-6)
-    print(f"After STFT - spec shape: {spec.shape}")
 
     
     if spec.dim() == 3:  # [batch, time, freq] or [batch, freq, time]
@@ -148,4 +147,50 @@ def mel_spectrogram_torch(y, n_fft, num_mels, sampling_rate, hop_size, win_size,
         spec = torch.matmul(mel_basis[fmax_dtype_device], spec)
 
     spec = spectral_normalize_torch(spec)
-    return spec
\ No newline at end of file
+    return spec
+
+
+class MelSpectrogram(nn.Module):
+    """Log-mel frontend with the mel basis and window registered as buffers.
+
+    Computes the same values as `mel_spectrogram_torch` / `spec_to_mel_torch`
+    without the global caches. With check_range=False (default) the forward pass
+    does no device to host synchronization.
+    """
+    def __init__(self, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False, check_range=False):
+        super().__init__()
+        self.n_fft = n_fft
+        self.hop_size = hop_size
+        self.win_size = win_size
+        self.center = center
+        self.check_range = check_range
+        mel = librosa_mel_fn(sr=sampling_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin, fmax=fmax)
+        self.register_buffer("mel_basis", torch.from_numpy(mel).float(), persistent=False)
+        self.register_buffer("window", torch.hann_window(win_size), persistent=False)
+
+    @classmethod
+    def from_hparams(cls, hparams, check_range=False):
+        """Build from the `data` section of the config"""
+        return cls(hparams.filter_length, hparams.n_mel_channels, hparams.sampling_rate,
+                   hparams.hop_length, hparams.win_length, hparams.mel_fmin, hparams.mel_fmax,
+                   check_range=check_range)
+
+    def spectrogram(self, y):
+        """[b, t] waveform -> [b, n_fft // 2 + 1, frames] linear magnitude"""
+        if self.check_range:
+            y_min, y_max = torch.stack(torch.aminmax(y.detach())).tolist()
+            if y_min < -1. or y_max > 1.:
+                print('waveform out of [-1, 1]: min {}, max {}'.format(y_min, y_max))
+        pad = (self.n_fft - self.hop_size) // 2
+        y = F.pad(y.unsqueeze(1), (pad, pad), mode='reflect').squeeze(1)
+        spec = torch.stft(y, self.n_fft, hop_length=self.hop_size, win_length=self.win_size, window=self.window,
+                          center=self.center, pad_mode='reflect', normalized=False, onesided=True, return_complex=True)
+        return torch.sqrt(spec.real.pow(2) + spec.imag.pow(2) + 1e-6)
+
+    def spec_to_mel(self, spec):
+        """[b, n_fft // 2 + 1, frames] linear magnitude -> [b, num_mels, frames] log-mel"""
+        return spectral_normalize_torch(torch.matmul(self.mel_basis, spec))
+
+    def forward(self, y):
+        """[b, t] waveform -> [b, num_mels, frames] log-mel"""
+        return self.spec_to_mel(self.spectrogram(y))
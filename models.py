@@ -1,3 +1,4 @@
+import contextlib
 import copy
 import math
 import torch
@@ -279,12 +280,9 @@ class iSTFT_Generator(torch.nn.Module):
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, modules.LRELU_SLOPE)
             x = self.ups[i](x)
-            xs = None
-            for j in range(self.num_kernels):
-                if xs is None:
-                    xs = self.resblocks[i*self.num_kernels+j](x)
-                else:
-                    xs += self.resblocks[i*self.num_kernels+j](x)
+            xs = self.resblocks[i*self.num_kernels](x)
+            for j in range(1, self.num_kernels):
+                xs = xs + self.resblocks[i*self.num_kernels+j](x)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
         x = self.reflection_pad(x)
@@ -337,11 +335,12 @@ class Multiband_iSTFT_Generator(torch.nn.Module):
         
         self.gen_istft_n_fft = gen_istft_n_fft
         self.gen_istft_hop_size = gen_istft_hop_size
+        # built once here rather than per forward (which also broke torch.compile graphs); their buffers are not saved
+        self.stft = TorchSTFT(filter_length=self.gen_istft_n_fft, hop_length=self.gen_istft_hop_size, win_length=self.gen_istft_n_fft)
+        self.pqmf = PQMF(torch.device("cpu"), self.subbands)
 
 
     def forward(self, x, g=None):
-      stft = TorchSTFT(filter_length=self.gen_istft_n_fft, hop_length=self.gen_istft_hop_size, win_length=self.gen_istft_n_fft).to(x.device)
-      pqmf = PQMF(x.device)
       
       x = self.conv_pre(x)#[B, ch, length]
         
@@ -350,12 +349,9 @@ class Multiband_iSTFT_Generator(torch.nn.Module):
           x = self.ups[i](x)
           
           
-          xs = None
-          for j in range(self.num_kernels):
-              if xs is None:
-                  xs = self.resblocks[i*self.num_kernels+j](x)
-              else:
-                  xs += self.resblocks[i*self.num_kernels+j](x)
+          xs = self.resblocks[i*self.num_kernels](x)
+          for j in range(1, self.num_kernels):
+              xs = xs + self.resblocks[i*self.num_kernels+j](x)
           x = xs / self.num_kernels
           
       x = F.leaky_relu(x)
@@ -366,11 +362,11 @@ class Multiband_iSTFT_Generator(torch.nn.Module):
       spec = torch.exp(x[:,:,:self.post_n_fft // 2 + 1, :])
       phase = math.pi*torch.sin(x[:,:, self.post_n_fft // 2 + 1:, :])
 
-      y_mb_hat = stft.inverse(torch.reshape(spec, (spec.shape[0]*self.subbands, self.gen_istft_n_fft // 2 + 1, spec.shape[-1])), torch.reshape(phase, (phase.shape[0]*self.subbands, self.gen_istft_n_fft // 2 + 1, phase.shape[-1])))
+      y_mb_hat = self.stft.inverse(torch.reshape(spec, (spec.shape[0]*self.subbands, self.gen_istft_n_fft // 2 + 1, spec.shape[-1])), torch.reshape(phase, (phase.shape[0]*self.subbands, self.gen_istft_n_fft // 2 + 1, phase.shape[-1])))
       y_mb_hat = torch.reshape(y_mb_hat, (x.shape[0], self.subbands, 1, y_mb_hat.shape[-1]))
       y_mb_hat = y_mb_hat.squeeze(-2)
 
-      y_g_hat = pqmf.synthesis(y_mb_hat)
+      y_g_hat = self.pqmf.synthesis(y_mb_hat)
 
       return y_g_hat, y_mb_hat
 
@@ -422,12 +418,11 @@ class Multistream_iSTFT_Generator(torch.nn.Module):
         self.register_buffer("updown_filter", updown_filter)
         self.multistream_conv_post = weight_norm(Conv1d(4, 1, kernel_size=63, bias=False, padding=get_padding(63, 1)))
         self.multistream_conv_post.apply(init_weights)
+        self.stft = TorchSTFT(filter_length=self.gen_istft_n_fft, hop_length=self.gen_istft_hop_size, win_length=self.gen_istft_n_fft)
         
 
 
     def forward(self, x, g=None):
-      stft = TorchSTFT(filter_length=self.gen_istft_n_fft, hop_length=self.gen_istft_hop_size, win_length=self.gen_istft_n_fft).to(x.device)
-      # pqmf = PQMF(x.device)
 
       x = self.conv_pre(x)#[B, ch, length]
         
@@ -438,12 +433,9 @@ class Multistream_iSTFT_Generator(torch.nn.Module):
           x = self.ups[i](x)
           
           
-          xs = None
-          for j in range(self.num_kernels):
-              if xs is None:
-                  xs = self.resblocks[i*self.num_kernels+j](x)
-              else:
-                  xs += self.resblocks[i*self.num_kernels+j](x)
+          xs = self.resblocks[i*self.num_kernels](x)
+          for j in range(1, self.num_kernels):
+              xs = xs + self.resblocks[i*self.num_kernels+j](x)
           x = xs / self.num_kernels
           
       x = F.leaky_relu(x)
@@ -454,11 +446,11 @@ class Multistream_iSTFT_Generator(torch.nn.Module):
       spec = torch.exp(x[:,:,:self.post_n_fft // 2 + 1, :])
       phase = math.pi*torch.sin(x[:,:, self.post_n_fft // 2 + 1:, :])
 
-      y_mb_hat = stft.inverse(torch.reshape(spec, (spec.shape[0]*self.subbands, self.gen_istft_n_fft // 2 + 1, spec.shape[-1])), torch.reshape(phase, (phase.shape[0]*self.subbands, self.gen_istft_n_fft // 2 + 1, phase.shape[-1])))
+      y_mb_hat = self.stft.inverse(torch.reshape(spec, (spec.shape[0]*self.subbands, self.gen_istft_n_fft // 2 + 1, spec.shape[-1])), torch.reshape(phase, (phase.shape[0]*self.subbands, self.gen_istft_n_fft // 2 + 1, phase.shape[-1])))
       y_mb_hat = torch.reshape(y_mb_hat, (x.shape[0], self.subbands, 1, y_mb_hat.shape[-1]))
       y_mb_hat = y_mb_hat.squeeze(-2)
 
-      y_mb_hat = F.conv_transpose1d(y_mb_hat, self.updown_filter.cuda(x.device) * self.subbands, stride=self.subbands)
+      y_mb_hat = F.conv_transpose1d(y_mb_hat, self.updown_filter * self.subbands, stride=self.subbands)
 
       y_g_hat = self.multistream_conv_post(y_mb_hat)
 
@@ -546,17 +538,33 @@ class MultiPeriodDiscriminator(torch.nn.Module):
         discs = discs + [DiscriminatorP(i, use_spectral_norm=use_spectral_norm) for i in periods]
         self.discriminators = nn.ModuleList(discs)
 
-    def forward(self, y, y_hat):
+    def forward(self, y, y_hat, concat=False, detach_fmap=False):
+        """
+        y: real waveform [b, 1, t], or None to only score y_hat (the real outputs and fmaps are then empty)
+        concat: score y and y_hat in one pass over torch.cat([y, y_hat]) per sub-discriminator
+        detach_fmap: return detached feature maps, e.g. to reuse the real ones of the D step
+          for the feature loss of the G step
+        """
         y_d_rs = []
         y_d_gs = []
         fmap_rs = []
         fmap_gs = []
         for i, d in enumerate(self.discriminators):
-            y_d_r, fmap_r = d(y)
-            y_d_g, fmap_g = d(y_hat)
-            y_d_rs.append(y_d_r)
+            if concat and y is not None:
+                b = y.size(0)
+                y_d, fmap = d(torch.cat([y, y_hat]))
+                y_d_r, y_d_g = y_d[:b], y_d[b:]
+                fmap_r, fmap_g = [f[:b] for f in fmap], [f[b:] for f in fmap]
+            else:
+                y_d_r, fmap_r = d(y) if y is not None else (None, [])
+                y_d_g, fmap_g = d(y_hat)
+            if detach_fmap:
+                fmap_r = [f.detach() for f in fmap_r]
+                fmap_g = [f.detach() for f in fmap_g]
+            if y is not None:
+                y_d_rs.append(y_d_r)
+                fmap_rs.append(fmap_r)
             y_d_gs.append(y_d_g)
-            fmap_rs.append(fmap_r)
             fmap_gs.append(fmap_g)
 
         return y_d_rs, y_d_gs, fmap_rs, fmap_gs
@@ -652,7 +660,25 @@ class SynthesizerTrn(nn.Module):
     if n_speakers > 1:
       self.emb_g = nn.Embedding(n_speakers, gin_channels)
 
-  def forward(self, x, x_lengths, y, y_lengths, sid=None):
+  def set_gradient_checkpointing(self, enc_q=None, flow=None, enc_p=None):
+    """Activation checkpointing of the posterior encoder WN, the WNs of the flow's coupling
+    layers and the text encoder's attention stack. Each is None (off), "layer" (keep only
+    each layer's input) or "block" (keep only the stack's input); the rest is recomputed in
+    backward.
+    """
+    for mode in (enc_q, flow, enc_p):
+      assert mode in (None, "layer", "block"), "gradient checkpointing is None, 'layer' or 'block', got {}".format(mode)
+    self.enc_q.enc.checkpointing = enc_q
+    for layer in self.flow.flows:
+      if isinstance(layer, modules.ResidualCouplingLayer):
+        layer.enc.checkpointing = flow
+    self.enc_p.encoder.checkpointing = enc_p
+
+  def forward(self, x, x_lengths, y, y_lengths, sid=None, durations=None, timer=None):
+    """durations: optional stored MAS durations [b, t_s] (frozen alignment), used instead of
+    computing the alignment scores and running MAS
+    timer: optional utils.StepTimer, times the alignment search as "mas"
+    """
 
     x, m_p, logs_p, x_mask = self.enc_p(x, x_lengths)
     if self.n_speakers > 0:
@@ -663,17 +689,17 @@ class SynthesizerTrn(nn.Module):
     z, m_q, logs_q, y_mask = self.enc_q(y, y_lengths, g=g)
     z_p = self.flow(z, y_mask, g=g)
 
-    with torch.no_grad():
-      # negative cross-entropy
-      s_p_sq_r = torch.exp(-2 * logs_p) # [b, d, t]
-      neg_cent1 = torch.sum(-0.5 * math.log(2 * math.pi) - logs_p, [1], keepdim=True) # [b, 1, t_s]
-      neg_cent2 = torch.matmul(-0.5 * (z_p ** 2).transpose(1, 2), s_p_sq_r) # [b, t_t, d] x [b, d, t_s] = [b, t_t, t_s]
-      neg_cent3 = torch.matmul(z_p.transpose(1, 2), (m_p * s_p_sq_r)) # [b, t_t, d] x [b, d, t_s] = [b, t_t, t_s]
-      neg_cent4 = torch.sum(-0.5 * (m_p ** 2) * s_p_sq_r, [1], keepdim=True) # [b, 1, t_s]
-      neg_cent = neg_cent1 + neg_cent2 + neg_cent3 + neg_cent4
-
+    if durations is not None:
       attn_mask = torch.unsqueeze(x_mask, 2) * torch.unsqueeze(y_mask, -1)
-      attn = monotonic_align.maximum_path(neg_cent, attn_mask.squeeze(1)).unsqueeze(1).detach()
+      attn = commons.generate_path(durations.unsqueeze(1).to(x_mask.dtype), attn_mask)
+    else:
+      with torch.no_grad(), timer("mas") if timer is not None else contextlib.nullcontext():
+        neg_cent = commons.neg_cent(z_p, m_p, logs_p) # [b, t_t, t_s]
+
+        # the MAS kernels accumulate into neg_cent in place; lengths replace the full attention mask
+        attn = monotonic_align.maximum_path_lengths(
+          neg_cent, y_mask.sum([1, 2]), x_mask.sum([1, 2]), overwrite=True).unsqueeze(1).detach()
+        del neg_cent
 
     w = attn.sum(2)
     if self.use_sdp:
@@ -118,6 +118,7 @@ class WN(torch.nn.Module):
     self.n_layers = n_layers
     self.gin_channels = gin_channels
     self.p_dropout = p_dropout
+    self.checkpointing = None # None, "layer" or "block", see SynthesizerTrn.set_gradient_checkpointing
 
     self.in_layers = torch.nn.ModuleList()
     self.res_skip_layers = torch.nn.ModuleList()
@@ -146,6 +147,11 @@ class WN(torch.nn.Module):
       self.res_skip_layers.append(res_skip_layer)
 
   def forward(self, x, x_mask, g=None, **kwargs):
+    if self.checkpointing == "block":
+      return commons.checkpoint(self._forward, x, x_mask, g)
+    return self._forward(x, x_mask, g)
+
+  def _forward(self, x, x_mask, g=None):
     output = torch.zeros_like(x)
     n_channels_tensor = torch.IntTensor([self.hidden_channels])
 
@@ -153,28 +159,38 @@ class WN(torch.nn.Module):
       g = self.cond_layer(g)
 
     for i in range(self.n_layers):
-      x_in = self.in_layers[i](x)
       if g is not None:
         cond_offset = i * 2 * self.hidden_channels
         g_l = g[:,cond_offset:cond_offset+2*self.hidden_channels,:]
       else:
-        g_l = torch.zeros_like(x_in)
-
-      acts = commons.fused_add_tanh_sigmoid_multiply(
-          x_in,
-          g_l,
-          n_channels_tensor)
-      acts = self.drop(acts)
-
-      res_skip_acts = self.res_skip_layers[i](acts)
-      if i < self.n_layers - 1:
-        res_acts = res_skip_acts[:,:self.hidden_channels,:]
-        x = (x + res_acts) * x_mask
-        output = output + res_skip_acts[:,self.hidden_channels:,:]
+        g_l = None
+
+      if self.checkpointing == "layer": # only x is kept between layers
+        x, skip = commons.checkpoint(self._layer, i, x, x_mask, g_l, n_channels_tensor)
       else:
-        output = output + res_skip_acts
+        x, skip = self._layer(i, x, x_mask, g_l, n_channels_tensor)
+      output = output + skip
     return output * x_mask
 
+  def _layer(self, i, x, x_mask, g_l, n_channels_tensor):
+    """Layer i: returns the residual output and the skip output"""
+    x_in = self.in_layers[i](x)
+    if g_l is None:
+      g_l = torch.zeros_like(x_in)
+
+    acts = commons.fused_add_tanh_sigmoid_multiply(
+        x_in,
+        g_l,
+        n_channels_tensor)
+    acts = self.drop(acts)
+
+    res_skip_acts = self.res_skip_layers[i](acts)
+    if i < self.n_layers - 1:
+      res_acts = res_skip_acts[:,:self.hidden_channels,:]
+      x = (x + res_acts) * x_mask
+      return x, res_skip_acts[:,self.hidden_channels:,:]
+    return x, res_skip_acts
+
   def remove_weight_norm(self):
     if self.gin_channels != 0:
       torch.nn.utils.remove_weight_norm(self.cond_layer)
@@ -1,19 +1,72 @@
 import numpy as np
 import torch
-from .monotonic_align.core import maximum_path_c
 
+from .core_torch import maximum_path_torch
+try:
+  from .monotonic_align.core import maximum_path_c
+except ImportError: # not built, see setup.py
+  maximum_path_c = None
+try:
+  from .core_numba import maximum_path_nb
+except ImportError:
+  maximum_path_nb = None
 
-def maximum_path(neg_cent, mask):
-  """ Cython optimized version.
+
+def _numpy_backend(kernel):
+  def maximum_path(neg_cent, t_t_max, t_s_max, overwrite=False):
+    device = neg_cent.device
+    dtype = neg_cent.dtype
+    # the kernels accumulate into neg_cent; copy only when it may not be overwritten or is not on the CPU
+    neg_cent = neg_cent.data.to("cpu", torch.float32, copy=not overwrite).numpy()
+    path = np.zeros(neg_cent.shape, dtype=np.int32)
+    kernel(path, neg_cent, t_t_max.data.cpu().numpy().astype(np.int32), t_s_max.data.cpu().numpy().astype(np.int32))
+    return torch.from_numpy(path).to(device=device, dtype=dtype)
+  return maximum_path
+
+
+def _torch_backend(neg_cent, t_t_max, t_s_max, overwrite=False):
+  return maximum_path_torch(neg_cent, t_t_max, t_s_max, overwrite).to(dtype=neg_cent.dtype)
+
+
+# name -> maximum_path(neg_cent, t_t_max, t_s_max, overwrite); all return the same path
+BACKENDS = {"torch": _torch_backend}
+if maximum_path_c is not None:
+  BACKENDS["cython"] = _numpy_backend(maximum_path_c)
+if maximum_path_nb is not None:
+  BACKENDS["numba"] = _numpy_backend(maximum_path_nb)
+
+# fastest first (python benchmark.py mas); CUDA inputs stay on the device
+PREFERENCE = {"cpu": ["cython", "numba", "torch"], "cuda": ["torch", "cython", "numba"]}
+_backend = None
+
+
+def set_backend(name):
+  """Force a backend for maximum_path, None to select by device"""
+  global _backend
+  if name is not None and name not in BACKENDS:
+    raise ValueError("MAS backend '{}' is not available, choose from {}".format(name, sorted(BACKENDS)))
+  _backend = name
+
+
+def get_backend(device):
+  if _backend is not None:
+    return _backend
+  return next(name for name in PREFERENCE.get(device.type, PREFERENCE["cpu"]) if name in BACKENDS)
+
+
+def maximum_path(neg_cent, mask, backend=None):
+  """
   neg_cent: [b, t_t, t_s]
   mask: [b, t_t, t_s]
   """
-  device = neg_cent.device
-  dtype = neg_cent.dtype
-  neg_cent = neg_cent.data.cpu().numpy().astype(np.float32)
-  path = np.zeros(neg_cent.shape, dtype=np.int32)
-
-  t_t_max = mask.sum(1)[:, 0].data.cpu().numpy().astype(np.int32)
-  t_s_max = mask.sum(2)[:, 0].data.cpu().numpy().astype(np.int32)
-  maximum_path_c(path, neg_cent, t_t_max, t_s_max)
-  return torch.from_numpy(path).to(device=device, dtype=dtype)
+  t_t_max = mask.sum(1)[:, 0]
+  t_s_max = mask.sum(2)[:, 0]
+  return maximum_path_lengths(neg_cent, t_t_max, t_s_max, backend)
+
+
+def maximum_path_lengths(neg_cent, t_t_max, t_s_max, backend=None, overwrite=False):
+  """maximum_path with the valid lengths instead of a full [b, t_t, t_s] mask.
+  neg_cent: [b, t_t, t_s], used as scratch space when overwrite=True
+  t_t_max, t_s_max: [b]
+  """
+  return BACKENDS[backend or get_backend(neg_cent.device)](neg_cent, t_t_max, t_s_max, overwrite)
@@ -0,0 +1,46 @@
+import torch
+
+
+@torch.no_grad()
+def maximum_path_torch(neg_cent, t_ys, t_xs, overwrite=False, max_neg_val=-1e9):
+  """Monotonic alignment search as batched tensor ops, on the device of neg_cent.
+
+  neg_cent: [b, t_y, t_x], accumulated in place when overwrite=True and it is float32.
+  t_ys / t_xs: [b] valid lengths.
+  Row y of the accumulated score only depends on row y - 1, so the forward pass
+  advances one frame at a time for the whole batch and every text position at
+  once; the backtrack advances one frame at a time for the whole batch.
+  Same result as the Cython kernel, including float32 accumulation and ties.
+  """
+  b, t_y, t_x = neg_cent.shape
+  device = neg_cent.device
+  value = neg_cent.float()
+  if value is neg_cent and not overwrite:
+    value = value.clone()
+  x_range = torch.arange(t_x, device=device)
+  neg = torch.full((b, 1), max_neg_val, dtype=value.dtype, device=device)
+
+  for y in range(1, t_y):
+    prev = value[:, y - 1]
+    # value[y-1, x] when x != y (x == y lies outside the band of row y-1)
+    v_cur = prev.masked_fill(x_range == y, max_neg_val)
+    # value[y-1, x-1], max_neg_val for x == 0
+    v_prev = torch.cat([neg, prev[:, :-1]], 1)
+    value[:, y] += torch.maximum(v_prev, v_cur)
+  # entries outside each item's band hold partial sums, but the backtrack never reads them
+
+  path = torch.zeros(b, t_y, t_x, dtype=torch.int32, device=device)
+  batch = torch.arange(b, device=device)
+  t_ys = t_ys.to(device=device, dtype=torch.long)
+  index = t_xs.to(device=device, dtype=torch.long) - 1
+  for y in range(t_y - 1, -1, -1):
+    active = y < t_ys
+    path[batch, y, index.clamp(min=0)] = active.to(torch.int32)
+    if y == 0:
+      break
+    prev = value[:, y - 1]
+    v_stay = prev.gather(1, index.clamp(min=0).unsqueeze(1)).squeeze(1)
+    v_move = prev.gather(1, (index - 1).clamp(min=0).unsqueeze(1)).squeeze(1)
+    move = active & (index != 0) & ((index == y) | (v_stay < v_move))
+    index = index - move.long()
+  return path
@@ -53,6 +53,7 @@ class PQMF(torch.nn.Module):
     def __init__(self, device, subbands=4, taps=62, cutoff_ratio=0.15, beta=9.0):
         """Initilize PQMF module.
         Args:
+            device (torch.device): Device of the filter coefficients.
             subbands (int): The number of subbands.
             taps (int): The number of filter taps.
             cutoff_ratio (float): Cut-off frequency ratio.
@@ -75,18 +76,18 @@ class PQMF(torch.nn.Module):
                 (-1) ** k * np.pi / 4)
 
         # convert to tensor
-        analysis_filter = torch.from_numpy(h_analysis).float().unsqueeze(1).cuda(device)
-        synthesis_filter = torch.from_numpy(h_synthesis).float().unsqueeze(0).cuda(device)
+        analysis_filter = torch.from_numpy(h_analysis).float().unsqueeze(1).to(device)
+        synthesis_filter = torch.from_numpy(h_synthesis).float().unsqueeze(0).to(device)
 
-        # register coefficients as beffer
-        self.register_buffer("analysis_filter", analysis_filter)
-        self.register_buffer("synthesis_filter", synthesis_filter)
+        # register coefficients as beffer (derived from the constructor arguments, so not saved)
+        self.register_buffer("analysis_filter", analysis_filter, persistent=False)
+        self.register_buffer("synthesis_filter", synthesis_filter, persistent=False)
 
         # filter for downsampling & upsampling
-        updown_filter = torch.zeros((subbands, subbands, subbands)).float().cuda(device)
+        updown_filter = torch.zeros((subbands, subbands, subbands)).float().to(device)
         for k in range(subbands):
             updown_filter[k, k, 0] = 1.0
-        self.register_buffer("updown_filter", updown_filter)
+        self.register_buffer("updown_filter", updown_filter, persistent=False)
         self.subbands = subbands
 
         # keep padding info
@@ -184,7 +184,7 @@ class TorchSTFT(torch.nn.Module):
         self.filter_length = filter_length
         self.hop_length = hop_length
         self.win_length = win_length
-        self.window = torch.from_numpy(get_window(window, win_length, fftbins=True).astype(np.float32))
+        self.register_buffer("window", torch.from_numpy(get_window(window, win_length, fftbins=True).astype(np.float32)), persistent=False)
 
     def transform(self, input_data):
         forward_transform = torch.stft(
@@ -195,6 +195,8 @@ class TorchSTFT(torch.nn.Module):
         return torch.abs(forward_transform), torch.angle(forward_transform)
 
     def inverse(self, magnitude, phase):
+        # complex half/bfloat16 is not supported on every device, run the iSTFT in float32 under autocast
+        magnitude, phase = magnitude.float(), phase.float()
         inverse_transform = torch.istft(
             magnitude * torch.exp(phase * 1j),
             self.filter_length, self.hop_length, self.win_length, window=self.window.to(magnitude.device))
@@ -1,8 +1,13 @@
 import os
+import sys
+import contextlib
+import time
+import signal
 import json
 import argparse
 import itertools
 import math
+import subprocess
 import torch
 from torch import nn, optim
 from torch.nn import functional as F
@@ -11,15 +16,16 @@ from torch.utils.tensorboard import SummaryWriter
 import torch.multiprocessing as mp
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.cuda.amp import autocast, GradScaler
-from pqmf import PQMF
 
 import commons
+import monotonic_align
 import utils
 from data_utils import (
   TextAudioLoader,
   TextAudioCollate,
-  DistributedBucketSampler
+  DistributedBucketSampler,
+  DurationStore,
+  SharedItemCache
 )
 from models import (
   SynthesizerTrn,
@@ -30,9 +36,9 @@ from losses import (
   discriminator_loss,
   feature_loss,
   kl_loss,
-  subband_stft_loss
+  SubbandSTFTLoss
 )
-from mel_processing import mel_spectrogram_torch, spec_to_mel_torch
+from mel_processing import MelSpectrogram
 from text.symbols import symbols
 
 torch.autograd.set_detect_anomaly(True)
@@ -41,54 +47,93 @@ global_step = 0
 
 
 def main():
-  """Assume Single Node Multi GPUs Training Only"""
-  assert torch.cuda.is_available(), "CPU training is not allowed."
-
-  n_gpus = torch.cuda.device_count()
+  """Single node training on all GPUs, or on `train.num_processes` CPU processes (gloo)"""
   os.environ['MASTER_ADDR'] = 'localhost'
   os.environ['MASTER_PORT'] = '65520'
-#   n_gpus = 1
 
   hps = utils.get_hparams()
-  mp.spawn(run, nprocs=n_gpus, args=(n_gpus, hps,))
-
-
-def run(rank, n_gpus, hps):
+  if utils.get_device_type(hps) == "cuda":
+    # DETAIL debug mode crashes DDP construction on gloo, so only NCCL runs get it
+    os.environ["TORCH_DISTRIBUTED_DEBUG"] = "DETAIL"
+    n_procs = torch.cuda.device_count()
+  else:
+    n_procs = getattr(hps.train, "num_processes", 1)
+  if getattr(hps.train, "eval_process", False):
+    # full validation of every new checkpoint, at low priority and off the training devices
+    subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "validate.py"),
+      "-m", os.path.relpath(hps.model_dir, "./logs"), "--watch", "--parent_pid", str(os.getpid()),
+      "--device", getattr(hps.train, "eval_device", "cpu")])
+  cache = SharedItemCache.from_hparams(hps.data)
+  if cache is not None: # node-wide counters, so the logged hit rate covers this run only
+    cache.reset_stats()
+  context = mp.spawn(run, nprocs=n_procs, args=(n_procs, hps,), join=False)
+  # preemption: the training processes save a resumable checkpoint and exit within preemption_check_interval steps
+  signal.signal(signal.SIGTERM, lambda signum, frame: [os.kill(p.pid, signal.SIGTERM) for p in context.processes if p.is_alive()])
+  while not context.join():
+    pass
+
+
+def run(rank, n_procs, hps):
   global global_step
   if rank == 0:
     logger = utils.get_logger(hps.model_dir)
     logger.info(hps)
     utils.check_git_hash(hps.model_dir)
-    writer = SummaryWriter(log_dir=hps.model_dir)
-    writer_eval = SummaryWriter(log_dir=os.path.join(hps.model_dir, "eval"))
+    # plots are rendered and summaries written off the training thread
+    writer = utils.SummaryWorker(SummaryWriter(log_dir=hps.model_dir))
+    writer_eval = utils.SummaryWorker(SummaryWriter(log_dir=os.path.join(hps.model_dir, "eval")))
+    checkpoint_writer = utils.CheckpointWriter.from_hparams(hps, logger)
 
-  dist.init_process_group(backend='nccl', init_method='env://', world_size=n_gpus, rank=rank)
+  device_type = utils.get_device_type(hps)
+  dist.init_process_group(backend='nccl' if device_type == "cuda" else 'gloo', init_method='env://', world_size=n_procs, rank=rank)
   torch.manual_seed(hps.train.seed)
-  torch.cuda.set_device(rank)
+  preemption = utils.PreemptionHandler.from_hparams(hps)
+  monotonic_align.set_backend(getattr(hps.train, "mas_backend", None))
+  if device_type == "cuda":
+    torch.cuda.set_device(rank)
+    device = torch.device("cuda", rank)
+  else:
+    torch.set_num_threads(max(1, os.cpu_count() // n_procs))
+    device = torch.device("cpu")
 
   train_dataset = TextAudioLoader(hps.data.training_files, hps.data)
+  if getattr(hps.train, "freeze_alignment_epoch", None) is not None:
+    train_dataset.durations = DurationStore(os.path.join(hps.model_dir, "durations"), rank).load()
+  max_frames = getattr(hps.train, "max_frames", None)
   train_sampler = DistributedBucketSampler(
       train_dataset,
       hps.train.batch_size,
-      [32,300,400,500,600,700,800],
-      num_replicas=n_gpus,
+      getattr(hps.train, "boundaries", None if max_frames else [32,300,400,500,600,700,800]),
+      num_replicas=n_procs,
       rank=rank,
-      shuffle=True)
-  collate_fn = TextAudioCollate(pad_multiple=8)
-  train_loader = DataLoader(train_dataset, num_workers=8, shuffle=False, pin_memory=True,
-      collate_fn=collate_fn, batch_sampler=train_sampler)
+      shuffle=True,
+      max_frames=max_frames,
+      frames_power=getattr(hps.train, "frames_power", 1),
+      max_batch_size=getattr(hps.train, "max_batch_size", None))
+  collate_fn = TextAudioCollate(
+      pad_multiple=8,
+      reuse_buffers=getattr(hps.train, "reuse_collate_buffers", False),
+      max_spec_len=train_sampler.boundaries[-1],
+      return_durations=train_dataset.durations is not None)
+  train_loader = DataLoader(train_dataset, num_workers=getattr(hps.train, "num_workers", 8), shuffle=False,
+      pin_memory=device.type == "cuda", collate_fn=collate_fn, batch_sampler=train_sampler)
   if rank == 0:
     eval_dataset = TextAudioLoader(hps.data.validation_files, hps.data)
     eval_loader = DataLoader(eval_dataset, num_workers=1, shuffle=False,
-        batch_size=hps.train.batch_size, pin_memory=True,
-        drop_last=False, collate_fn=collate_fn)
+        batch_size=hps.train.batch_size, pin_memory=device.type == "cuda",
+        drop_last=False, collate_fn=TextAudioCollate(pad_multiple=8))
 
   net_g = SynthesizerTrn(
       len(symbols),
       hps.data.filter_length // 2 + 1,
       hps.train.segment_size // hps.data.hop_length,
-      **hps.model).cuda(rank)
-  net_d = MultiPeriodDiscriminator(hps.model.use_spectral_norm).cuda(rank)
+      **hps.model).to(device)
+  net_g.set_gradient_checkpointing(**getattr(hps.train, "gradient_checkpointing", {}))
+  net_d = MultiPeriodDiscriminator(hps.model.use_spectral_norm).to(device)
+  if getattr(hps.train, "compile", False):
+    # dec and D only see fixed segment_size shapes; Module.compile keeps the parameter names of checkpoints
+    net_g.dec.compile()
+    net_d.compile()
   optim_g = torch.optim.AdamW(
       net_g.parameters(), 
       hps.train.learning_rate, 
@@ -99,33 +144,60 @@ def run(rank, n_gpus, hps):
       hps.train.learning_rate, 
       betas=hps.train.betas, 
       eps=hps.train.eps)
-  net_g = DDP(net_g, device_ids=[rank])
-  net_d = DDP(net_d, device_ids=[rank])
-
-  try:
-    _, _, _, epoch_str = utils.load_checkpoint(utils.latest_checkpoint_path(hps.model_dir, "G_*.pth"), net_g, optim_g)
-    _, _, _, epoch_str = utils.load_checkpoint(utils.latest_checkpoint_path(hps.model_dir, "D_*.pth"), net_d, optim_d)
-    global_step = (epoch_str - 1) * len(train_loader)
-  except:
-    epoch_str = 1
-    global_step = 0
+  device_ids = [rank] if device.type == "cuda" else None
+  net_g = DDP(net_g, device_ids=device_ids)
+  net_d = DDP(net_d, device_ids=device_ids)
+
+  epoch_str, global_step, train_state = 1, 0, None
+  checkpoint_step = utils.latest_checkpoint_step(hps.model_dir)
+  if checkpoint_step is not None:
+    _, _, _, epoch_str = utils.load_checkpoint(os.path.join(hps.model_dir, "G_{}.pth".format(checkpoint_step)), net_g, optim_g)
+    _, _, _, epoch_str = utils.load_checkpoint(os.path.join(hps.model_dir, "D_{}.pth".format(checkpoint_step)), net_d, optim_d)
+    # global_step counts optimizer steps, one per grad_accum_steps batches (the last group of an epoch may be shorter)
+    global_step = (epoch_str - 1) * math.ceil(len(train_loader) / getattr(hps.train, "grad_accum_steps", 1))
+    train_state = utils.load_train_state(hps.model_dir, rank, checkpoint_step)
+  if train_state is not None: # resume right after the checkpointed step instead of at its epoch start
+    epoch_str, global_step = train_state["epoch"], checkpoint_step + 1
+    train_sampler.set_start_batch(train_state["batch"])
 
   scheduler_g = torch.optim.lr_scheduler.ExponentialLR(optim_g, gamma=hps.train.lr_decay, last_epoch=epoch_str-2)
   scheduler_d = torch.optim.lr_scheduler.ExponentialLR(optim_d, gamma=hps.train.lr_decay, last_epoch=epoch_str-2)
 
-  scaler = GradScaler(enabled=hps.train.fp16_run)
+  scaler = torch.amp.GradScaler(device.type, enabled=utils.get_autocast_dtype(hps, device.type) == torch.float16)
+  rng_state = None
+  if train_state is not None:
+    scheduler_g.load_state_dict(train_state["schedulers"][0])
+    scheduler_d.load_state_dict(train_state["schedulers"][1])
+    if train_state["scaler"]:
+      scaler.load_state_dict(train_state["scaler"])
+    rng_state = train_state["rng"]
+  mel_fn = MelSpectrogram.from_hparams(hps.data, check_range=getattr(hps.train, "check_wav_range", False)).to(device)
+  subband_loss = SubbandSTFTLoss.from_hparams(hps, timing=rank == 0).to(device) if hps.model.mb_istft_vits else None
 
   for epoch in range(epoch_str, hps.train.epochs + 1):
     if rank==0:
-      train_and_evaluate(rank, epoch, hps, [net_g, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, [train_loader, eval_loader], logger, [writer, writer_eval])
+      preempted = train_and_evaluate(rank, epoch, hps, [net_g, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, [train_loader, eval_loader], logger, [writer, writer_eval], mel_fn, subband_loss, checkpoint_writer, preemption, rng_state)
     else:
-      train_and_evaluate(rank, epoch, hps, [net_g, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, [train_loader, None], None, None)
+      preempted = train_and_evaluate(rank, epoch, hps, [net_g, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, [train_loader, None], None, None, mel_fn, subband_loss, None, preemption, rng_state)
+    rng_state = None
+    if preempted:
+      break
     scheduler_g.step()
     scheduler_d.step()
+    if train_dataset.durations is not None and utils.alignment_schedule(hps, epoch)[1]:
+      # every rank saves the durations it computed, then merges those of all ranks
+      train_dataset.durations.save()
+      dist.barrier()
+      train_dataset.durations.load()
+
+  if rank == 0:
+    checkpoint_writer.close()
+    writer.close()
+    writer_eval.close()
 
 
 
-def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loaders, logger, writers):
+def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loaders, logger, writers, mel_fn, subband_loss=None, checkpoint_writer=None, preemption=None, rng_state=None):
   net_g, net_d = nets
   optim_g, optim_d = optims
   scheduler_g, scheduler_d = schedulers
@@ -135,80 +207,122 @@ def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loade
 
   train_loader.batch_sampler.set_epoch(epoch)
   global global_step
+  device = next(net_g.parameters()).device
+  amp_dtype = utils.get_autocast_dtype(hps, device.type)
+  batched_d = getattr(hps.train, "batched_discriminator", False)
+  eval_process = getattr(hps.train, "eval_process", False)
+  accum_steps = getattr(hps.train, "grad_accum_steps", 1)
+  frozen_alignment, record_alignment = utils.alignment_schedule(hps, epoch)
+  log_start, log_steps, log_utts, log_samples, log_frames, log_padded = time.perf_counter(), 0, 0, 0, 0, 0
+  timer = utils.StepTimer(device, enabled=rank == 0)
 
   net_g.train()
   net_d.train()
-  for batch_idx, (x, x_lengths, spec, spec_lengths, y, y_lengths) in enumerate(train_loader):
-    x, x_lengths = x.cuda(rank, non_blocking=True), x_lengths.cuda(rank, non_blocking=True)
-    spec, spec_lengths = spec.cuda(rank, non_blocking=True), spec_lengths.cuda(rank, non_blocking=True)
-    y, y_lengths = y.cuda(rank, non_blocking=True), y_lengths.cuda(rank, non_blocking=True)
-
-    with autocast(enabled=hps.train.fp16_run):
-      y_hat, y_hat_mb, l_length, attn, ids_slice, x_mask, z_mask,\
-      (z, z_p, m_p, logs_p, m_q, logs_q) = net_g(x, x_lengths, spec, spec_lengths)
-
-      mel = spec_to_mel_torch(
-          spec, 
-          hps.data.filter_length, 
-          hps.data.n_mel_channels, 
-          hps.data.sampling_rate,
-          hps.data.mel_fmin, 
-          hps.data.mel_fmax)
-      y_mel = commons.slice_segments(mel, ids_slice, hps.train.segment_size // hps.data.hop_length)
-      y_hat_mel = mel_spectrogram_torch(
-          y_hat.squeeze(1), 
-          hps.data.filter_length, 
-          hps.data.n_mel_channels, 
-          hps.data.sampling_rate, 
-          hps.data.hop_length, 
-          hps.data.win_length, 
-          hps.data.mel_fmin, 
-          hps.data.mel_fmax
-      )
-
-      y = commons.slice_segments(y, ids_slice * hps.data.hop_length, hps.train.segment_size) # slice 
-
-      # Discriminator
-      y_d_hat_r, y_d_hat_g, _, _ = net_d(y, y_hat.detach())
-      with autocast(enabled=False):
-        loss_disc, losses_disc_r, losses_disc_g = discriminator_loss(y_d_hat_r, y_d_hat_g)
-        loss_disc_all = loss_disc
-    optim_d.zero_grad()
-    scaler.scale(loss_disc_all).backward()
-    scaler.unscale_(optim_d)
-    grad_norm_d = commons.clip_grad_value_(net_d.parameters(), None)
-    scaler.step(optim_d)
-
-    
-
-
-    with autocast(enabled=hps.train.fp16_run):
-      # Generator
-      y_d_hat_r, y_d_hat_g, fmap_r, fmap_g = net_d(y, y_hat)
-      with autocast(enabled=False):
-        loss_dur = torch.sum(l_length.float())
-        loss_mel = F.l1_loss(y_mel, y_hat_mel) * hps.train.c_mel
-        loss_kl = kl_loss(z_p, logs_q, m_p, logs_p, z_mask) * hps.train.c_kl
-
-        loss_fm = feature_loss(fmap_r, fmap_g)
-        loss_gen, losses_gen = generator_loss(y_d_hat_g)
+  start_batch = train_loader.batch_sampler.start_batch # reset by the sampler once iterated
+  loader_iter = iter(train_loader)
+  if rng_state is not None:
+    # restored after the loader drew its worker seeds, so the resumed steps draw the same random numbers
+    utils.set_rng_state(rng_state, device)
+  step_end = time.perf_counter()
+  for batch_idx, (x, x_lengths, spec, spec_lengths, y, y_lengths, *stored) in enumerate(loader_iter, start_batch):
+    timer.add("data_wait", time.perf_counter() - step_end)
+    log_frames += int(spec_lengths.sum())
+    log_padded += spec.size(0) * spec.size(2)
+    with timer("h2d"):
+      x, x_lengths = x.to(device, non_blocking=True), x_lengths.to(device, non_blocking=True)
+      spec, spec_lengths = spec.to(device, non_blocking=True), spec_lengths.to(device, non_blocking=True)
+      y, y_lengths = y.to(device, non_blocking=True), y_lengths.to(device, non_blocking=True)
+      if y.dtype == torch.int16: # data.int16_audio: normalize on the device
+        y = y.float() / hps.data.max_wav_value
+      # stored durations (DurationStore) replace MAS once every item of the batch has them
+      durations = stored[0].to(device, non_blocking=True) if frozen_alignment and stored[1].all() else None
+
+    # gradient accumulation: optimizer steps every accum_steps micro-batches (and at the end of the
+    # epoch); the gradients of the earlier ones are only all-reduced together with the last one
+    first = batch_idx % accum_steps == 0
+    sync = (batch_idx + 1) % accum_steps == 0 or batch_idx + 1 == len(train_loader)
+    group_size = min(accum_steps, len(train_loader) - batch_idx // accum_steps * accum_steps)
+    with contextlib.ExitStack() as accumulating:
+      if not sync:
+        accumulating.enter_context(net_g.no_sync())
+        accumulating.enter_context(net_d.no_sync())
+      with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+        with timer("g_forward"):
+          y_hat, y_hat_mb, l_length, attn, ids_slice, x_mask, z_mask,\
+          (z, z_p, m_p, logs_p, m_q, logs_q) = net_g(x, x_lengths, spec, spec_lengths, durations=durations, timer=timer)
+
+          mel = mel_fn.spec_to_mel(spec)
+          y_mel = commons.slice_segments(mel, ids_slice, hps.train.segment_size // hps.data.hop_length)
+          y_hat_mel = mel_fn(y_hat.squeeze(1))
+
+          y = commons.slice_segments(y, ids_slice * hps.data.hop_length, hps.train.segment_size) # slice 
+
+        # Discriminator
+        with timer("d_forward"):
+          if batched_d: # one pass over real and fake, keep the real fmaps for the feature loss
+            y_d_hat_r, y_d_hat_g, fmap_r, _ = net_d(y, y_hat.detach(), concat=True, detach_fmap=True)
+          else:
+            y_d_hat_r, y_d_hat_g, _, _ = net_d(y, y_hat.detach())
+          with torch.autocast(device.type, enabled=False):
+            loss_disc, losses_disc_r, losses_disc_g = discriminator_loss(y_d_hat_r, y_d_hat_g)
+            loss_disc_all = loss_disc
+      with timer("d_backward"):
+        if first:
+          optim_d.zero_grad()
+        scaler.scale(loss_disc_all / group_size).backward()
+      if sync:
+        with timer("d_optimizer"):
+          scaler.unscale_(optim_d)
+          grad_norm_d = commons.clip_grad_value_(net_d.parameters(), None)
+          scaler.step(optim_d)
+
+      # the generator loss gives D no gradient: it would otherwise add to D's accumulated gradient
+      # (and be all-reduced for nothing)
+      net_d.requires_grad_(False)
+      with timer("g_forward"), torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+        # Generator
+        with net_d.no_sync():
+          if batched_d:
+            _, y_d_hat_g, _, fmap_g = net_d(None, y_hat)
+          else:
+            y_d_hat_r, y_d_hat_g, fmap_r, fmap_g = net_d(y, y_hat)
+        net_d.requires_grad_(True)
+        with torch.autocast(device.type, enabled=False):
+          loss_dur = torch.sum(l_length.float())
+          loss_mel = F.l1_loss(y_mel, y_hat_mel) * hps.train.c_mel
+          loss_kl = kl_loss(z_p, logs_q, m_p, logs_p, z_mask) * hps.train.c_kl
+
+          loss_fm = feature_loss(fmap_r, fmap_g)
+          loss_gen, losses_gen = generator_loss(y_d_hat_g)
         
-        if hps.model.mb_istft_vits == True:
-          pqmf = PQMF(y.device)
-          y_mb = pqmf.analysis(y)
-          loss_subband = subband_stft_loss(hps, y_mb, y_hat_mb)
-        else:
-          loss_subband = torch.tensor(0.0)
-
-        loss_gen_all = loss_gen + loss_fm + loss_mel + loss_dur + loss_kl + loss_subband
-
-    optim_g.zero_grad()
-    scaler.scale(loss_gen_all).backward()
-    scaler.unscale_(optim_g)
-    grad_norm_g = commons.clip_grad_value_(net_g.parameters(), None)
-    scaler.step(optim_g)
-    scaler.update()
-
+          if hps.model.mb_istft_vits == True:
+            loss_subband = subband_loss(y, y_hat_mb)
+          else:
+            loss_subband = torch.tensor(0.0)
+
+          loss_gen_all = loss_gen + loss_fm + loss_mel + loss_dur + loss_kl + loss_subband
+
+      with timer("g_backward"):
+        if first:
+          optim_g.zero_grad()
+        scaler.scale(loss_gen_all / group_size).backward()
+      if sync:
+        with timer("g_optimizer"):
+          scaler.unscale_(optim_g)
+          grad_norm_g = commons.clip_grad_value_(net_g.parameters(), None)
+          scaler.step(optim_g)
+          scaler.update()
+    log_utts += x.size(0)
+    log_samples += y_lengths.sum()
+    if record_alignment and durations is None:
+      train_loader.dataset.durations.update(
+        stored[2], attn.float().sum(2).squeeze(1).round().to(torch.int16).cpu().numpy(), x_lengths.cpu(), epoch)
+    if not sync:
+      step_end = time.perf_counter()
+      continue
+    log_steps += 1
+
+    stop = preemption.should_stop(global_step)
     if rank==0:
       if global_step % hps.train.log_interval == 0:
         lr = optim_g.param_groups[0]['lr']
@@ -217,45 +331,87 @@ def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loade
           epoch,
           100. * batch_idx / len(train_loader)))
         logger.info([x.item() for x in losses] + [global_step, lr])
+        elapsed = time.perf_counter() - log_start
+        throughput = {
+          "throughput/steps_per_sec": log_steps / elapsed,
+          "throughput/utts_per_sec": log_utts / elapsed,
+          "throughput/audio_sec_per_sec": float(log_samples) / hps.data.sampling_rate / elapsed,
+          "throughput/padding_ratio": log_padded / log_frames}
+        step_time = {"time/{}".format(k): v / log_steps for k, v in timer.pop().items()}
+        step_time["time/step"] = elapsed / log_steps
+        if device.type == "cuda":
+          throughput["memory/peak_allocated_gb"] = torch.cuda.max_memory_allocated(device) / 2**30
+          torch.cuda.reset_peak_memory_stats(device)
+        if subband_loss is not None:
+          throughput["time/subband_loss_share"] = subband_loss.pop_elapsed() / elapsed
+        logger.info('Throughput per process ({}): {}'.format(device, throughput))
+        logger.info('Seconds per step: {}'.format(step_time))
+        log_start, log_steps, log_utts, log_samples, log_frames, log_padded = time.perf_counter(), 0, 0, 0, 0, 0
         
         scalar_dict = {"loss/g/total": loss_gen_all, "loss/d/total": loss_disc_all, "learning_rate": lr, "grad_norm_d": grad_norm_d, "grad_norm_g": grad_norm_g}
+        scalar_dict.update(throughput)
+        scalar_dict.update(step_time)
+        scalar_dict.update(checkpoint_writer.stats())
+        scalar_dict["summary/dropped"] = writer.dropped
         scalar_dict.update({"loss/g/fm": loss_fm, "loss/g/mel": loss_mel, "loss/g/dur": loss_dur, "loss/g/kl": loss_kl, "loss/g/subband": loss_subband})
 
         scalar_dict.update({"loss/g/{}".format(i): v for i, v in enumerate(losses_gen)})
         scalar_dict.update({"loss/d_r/{}".format(i): v for i, v in enumerate(losses_disc_r)})
         scalar_dict.update({"loss/d_g/{}".format(i): v for i, v in enumerate(losses_disc_g)})
-        image_dict = { 
-            "slice/mel_org": utils.plot_spectrogram_to_numpy(y_mel[0].data.cpu().numpy()),
-            "slice/mel_gen": utils.plot_spectrogram_to_numpy(y_hat_mel[0].data.cpu().numpy()), 
-            "all/mel": utils.plot_spectrogram_to_numpy(mel[0].data.cpu().numpy()),
-            "all/attn": utils.plot_alignment_to_numpy(attn[0,0].data.cpu().numpy())
+        if train_loader.dataset.cache is not None:
+          cache_stats = train_loader.dataset.cache.stats()
+          logger.info('Cache: {}'.format(cache_stats))
+          scalar_dict.update({"cache/{}".format(k): v for k, v in cache_stats.items()})
+        utils.append_jsonl(os.path.join(hps.model_dir, "metrics.jsonl"), dict(
+          step=global_step, epoch=epoch, **{k: float(v) for k, v in scalar_dict.items()}))
+        spectrograms = {
+            "slice/mel_org": y_mel[0].data.float().cpu().numpy(),
+            "slice/mel_gen": y_hat_mel[0].data.float().cpu().numpy(),
+            "all/mel": mel[0].data.float().cpu().numpy()
         }
-        utils.summarize(
-          writer=writer,
-          global_step=global_step, 
-          images=image_dict,
+        writer.summarize(
+          global_step=global_step,
+          spectrograms=spectrograms,
+          alignments={"all/attn": attn[0,0].data.float().cpu().numpy()},
           scalars=scalar_dict)
 
-      if global_step % hps.train.eval_interval == 0:
-        evaluate(hps, net_g, eval_loader, writer_eval)
-        utils.save_checkpoint(net_g, optim_g, hps.train.learning_rate, epoch, os.path.join(hps.model_dir, "G_{}.pth".format(global_step)))
-        utils.save_checkpoint(net_d, optim_d, hps.train.learning_rate, epoch, os.path.join(hps.model_dir, "D_{}.pth".format(global_step)))
+      if global_step % hps.train.eval_interval == 0 and not eval_process:
+        evaluate(hps, net_g, eval_loader, writer_eval, mel_fn)
+    if global_step % hps.train.eval_interval == 0 or stop:
+      if rank == 0:
+        checkpoint_writer.save(net_g, optim_g, hps.train.learning_rate, epoch, os.path.join(hps.model_dir, "G_{}.pth".format(global_step)))
+        checkpoint_writer.save(net_d, optim_d, hps.train.learning_rate, epoch, os.path.join(hps.model_dir, "D_{}.pth".format(global_step)))
+      utils.save_train_state(hps.model_dir, rank, global_step, epoch, batch_idx + 1, scaler, schedulers, device)
     global_step += 1
+    step_end = time.perf_counter()
+    if stop:
+      if rank == 0:
+        logger.info('Preempted: saved a resumable checkpoint at step {}'.format(global_step - 1))
+      return True
 
   
   if rank == 0:
     logger.info('====> Epoch: {}'.format(epoch))
+    logger.info('Padding: {padded_frames} padded / {real_frames} real frames (ratio {padding_ratio:.3f})'.format(
+      **train_loader.batch_sampler.frame_stats))
+    if train_loader.dataset.durations is not None:
+      logger.info('Alignment: {} (stored durations for {} utterances)'.format(
+        "frozen" if frozen_alignment else "MAS", len(train_loader.dataset.durations)))
+  return False
   
     
 
  
-def evaluate(hps, generator, eval_loader, writer_eval):
+def evaluate(hps, generator, eval_loader, writer_eval, mel_fn):
+    device = next(generator.parameters()).device
     generator.eval()
     with torch.no_grad():
       for batch_idx, (x, x_lengths, spec, spec_lengths, y, y_lengths) in enumerate(eval_loader):
-        x, x_lengths = x.cuda(0), x_lengths.cuda(0)
-        spec, spec_lengths = spec.cuda(0), spec_lengths.cuda(0)
-        y, y_lengths = y.cuda(0), y_lengths.cuda(0)
+        x, x_lengths = x.to(device), x_lengths.to(device)
+        spec, spec_lengths = spec.to(device), spec_lengths.to(device)
+        y, y_lengths = y.to(device), y_lengths.to(device)
+        if y.dtype == torch.int16:
+          y = y.float() / hps.data.max_wav_value
 
         # remove else
         x = x[:1]
@@ -268,37 +424,21 @@ def evaluate(hps, generator, eval_loader, writer_eval):
       y_hat, y_hat_mb, attn, mask, *_ = generator.module.infer(x, x_lengths, max_len=1000)
       y_hat_lengths = mask.sum([1,2]).long() * hps.data.hop_length
 
-      mel = spec_to_mel_torch(
-        spec, 
-        hps.data.filter_length, 
-        hps.data.n_mel_channels, 
-        hps.data.sampling_rate,
-        hps.data.mel_fmin, 
-        hps.data.mel_fmax)
-      y_hat_mel = mel_spectrogram_torch(
-        y_hat.squeeze(1).float(),
-        hps.data.filter_length,
-        hps.data.n_mel_channels,
-        hps.data.sampling_rate,
-        hps.data.hop_length,
-        hps.data.win_length,
-        hps.data.mel_fmin,
-        hps.data.mel_fmax
-      )
-    image_dict = {
-      "gen/mel": utils.plot_spectrogram_to_numpy(y_hat_mel[0].cpu().numpy())
+      mel = mel_fn.spec_to_mel(spec)
+      y_hat_mel = mel_fn(y_hat.squeeze(1).float())
+    spectrograms = {
+      "gen/mel": y_hat_mel[0].cpu().numpy()
     }
     audio_dict = {
-      "gen/audio": y_hat[0,:,:y_hat_lengths[0]]
+      "gen/audio": y_hat[0,:,:y_hat_lengths[0]].float().cpu()
     }
     if global_step == 0:
-      image_dict.update({"gt/mel": utils.plot_spectrogram_to_numpy(mel[0].cpu().numpy())})
-      audio_dict.update({"gt/audio": y[0,:,:y_lengths[0]]})
+      spectrograms.update({"gt/mel": mel[0].cpu().numpy()})
+      audio_dict.update({"gt/audio": y[0,:,:y_lengths[0]].cpu()})
 
-    utils.summarize(
-      writer=writer_eval,
-      global_step=global_step, 
-      images=image_dict,
+    writer_eval.summarize(
+      global_step=global_step,
+      spectrograms=spectrograms,
       audios=audio_dict,
       audio_sampling_rate=hps.data.sampling_rate
     )
@@ -306,7 +446,4 @@ def evaluate(hps, generator, eval_loader, writer_eval):
 
                            
 if __name__ == "__main__":
-  os.environ[
-        "TORCH_DISTRIBUTED_DEBUG"
-    ] = "DETAIL"
   main()
@@ -2,12 +2,19 @@ import os
 import glob
 import sys
 import argparse
+import contextlib
 import logging
 import json
 import subprocess
+import queue
+import random
+import signal
+import threading
+import time
 import numpy as np
 from scipy.io.wavfile import read
 import torch
+import torch.distributed as dist
 
 MATPLOTLIB_FLAG = False
 
@@ -43,17 +50,197 @@ def load_checkpoint(checkpoint_path, model, optimizer=None):
   return model, optimizer, learning_rate, iteration
 
 
-def save_checkpoint(model, optimizer, learning_rate, iteration, checkpoint_path):
-  logger.info("Saving model and optimizer state at iteration {} to {}".format(
-    iteration, checkpoint_path))
+def _checkpoint_dict(model, optimizer, learning_rate, iteration):
   if hasattr(model, 'module'):
     state_dict = model.module.state_dict()
   else:
     state_dict = model.state_dict()
-  torch.save({'model': state_dict,
-              'iteration': iteration,
-              'optimizer': optimizer.state_dict(),
-              'learning_rate': learning_rate}, checkpoint_path)
+  return {'model': state_dict,
+          'iteration': iteration,
+          'optimizer': optimizer.state_dict(),
+          'learning_rate': learning_rate}
+
+
+def _save_atomic(obj, checkpoint_path):
+  """torch.save to a temporary file renamed over `checkpoint_path`, so a crash never leaves a truncated checkpoint"""
+  tmp_path = checkpoint_path + ".tmp"
+  torch.save(obj, tmp_path)
+  os.replace(tmp_path, checkpoint_path)
+
+
+def save_checkpoint(model, optimizer, learning_rate, iteration, checkpoint_path):
+  logger.info("Saving model and optimizer state at iteration {} to {}".format(
+    iteration, checkpoint_path))
+  _save_atomic(_checkpoint_dict(model, optimizer, learning_rate, iteration), checkpoint_path)
+
+
+def _to_cpu(obj):
+  """Copy of a (nested) state dict with every tensor copied to the CPU"""
+  if isinstance(obj, torch.Tensor):
+    return obj.detach().to("cpu", copy=True)
+  if isinstance(obj, dict):
+    return {k: _to_cpu(v) for k, v in obj.items()}
+  if isinstance(obj, (list, tuple)):
+    return type(obj)(_to_cpu(v) for v in obj)
+  return obj
+
+
+class CheckpointWriter():
+  """ Saves checkpoints from a background thread.
+
+  `save` only snapshots the model and optimizer state to the CPU and queues it; the
+  thread serializes it to a temporary file, renames it into place and then prunes
+  the G_/D_ pairs down to the newest `keep_last` steps that have both files, plus
+  every step that is a multiple of `keep_every` (None keeps all). Only steps older
+  than the newest complete pair are removed, so a crash between writing G_{n} and
+  D_{n} still leaves a pair to resume from. At most `max_pending` snapshots wait in
+  the queue, after which `save` blocks.
+  """
+  def __init__(self, keep_last=None, keep_every=None, max_pending=2, logger=logger):
+    self.logger = logger
+    self.keep_last = keep_last
+    self.keep_every = keep_every
+    self.queue = queue.Queue(maxsize=max_pending)
+    self.last_snapshot_sec = 0.
+    self.last_save_sec = 0.
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  @classmethod
+  def from_hparams(cls, hps, logger=logger):
+    return cls(getattr(hps.train, "keep_checkpoints", None), getattr(hps.train, "keep_checkpoint_every", None), logger=logger)
+
+  def save(self, model, optimizer, learning_rate, iteration, checkpoint_path):
+    start = time.perf_counter()
+    snapshot = _to_cpu(_checkpoint_dict(model, optimizer, learning_rate, iteration))
+    self.last_snapshot_sec = time.perf_counter() - start
+    self.queue.put((snapshot, iteration, checkpoint_path))
+
+  def _run(self):
+    while True:
+      snapshot, iteration, checkpoint_path = self.queue.get()
+      try:
+        start = time.perf_counter()
+        _save_atomic(snapshot, checkpoint_path)
+        self.last_save_sec = time.perf_counter() - start
+        self.logger.info("Saved model and optimizer state at iteration {} to {} in {:.2f}s".format(
+          iteration, checkpoint_path, self.last_save_sec))
+        self._prune(checkpoint_path)
+      except Exception:
+        self.logger.exception("Saving {} failed".format(checkpoint_path))
+      finally:
+        self.queue.task_done()
+
+  def _prune(self, checkpoint_path):
+    if self.keep_last is None:
+      return
+    dir_path = os.path.dirname(checkpoint_path)
+    g_paths, d_paths = _checkpoint_paths(dir_path, "G_"), _checkpoint_paths(dir_path, "D_")
+    complete = sorted(g_paths.keys() & d_paths.keys())
+    if not complete:
+      return
+    keep = set(complete[-max(self.keep_last, 1):])
+    for step in (g_paths.keys() | d_paths.keys()) - keep:
+      if step < complete[-1] and not (self.keep_every and step % self.keep_every == 0):
+        for paths in (g_paths, d_paths):
+          if step in paths:
+            os.remove(paths[step])
+
+  def stats(self):
+    return {"checkpoint/snapshot_sec": self.last_snapshot_sec, "checkpoint/save_sec": self.last_save_sec,
+            "checkpoint/queue_depth": self.queue.qsize()}
+
+  def close(self):
+    """Waits until every queued checkpoint is on disk"""
+    self.queue.join()
+
+
+def _checkpoint_paths(dir_path, prefix):
+  """{step: path} of the `prefix`{step}.pth checkpoints in `dir_path`"""
+  paths = {}
+  for p in glob.glob(os.path.join(dir_path, prefix + "*.pth")):
+    step = os.path.basename(p)[len(prefix):-len(".pth")]
+    if step.isdigit():
+      paths[int(step)] = p
+  return paths
+
+
+def latest_checkpoint_step(dir_path):
+  """Newest step with both G_{step}.pth and D_{step}.pth in `dir_path`, None if there is none"""
+  common = _checkpoint_paths(dir_path, "G_").keys() & _checkpoint_paths(dir_path, "D_").keys()
+  return max(common) if common else None
+
+
+def get_rng_state(device):
+  state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+  if device.type == "cuda":
+    state["cuda"] = torch.cuda.get_rng_state(device)
+  return state
+
+
+def set_rng_state(state, device):
+  random.setstate(state["python"])
+  np.random.set_state(state["numpy"])
+  torch.set_rng_state(state["torch"])
+  if "cuda" in state and device.type == "cuda":
+    torch.cuda.set_rng_state(state["cuda"], device)
+
+
+def save_train_state(model_dir, rank, checkpoint_step, epoch, batch, scaler, schedulers, device):
+  """Everything besides the G/D checkpoint of `checkpoint_step` needed to resume rank `rank` at
+  batch `batch` of `epoch`: RNG states, grad scaler and LR schedulers"""
+  _save_atomic({
+    "checkpoint_step": checkpoint_step,
+    "epoch": epoch,
+    "batch": batch,
+    "rng": get_rng_state(device),
+    "scaler": scaler.state_dict(),
+    "schedulers": [s.state_dict() for s in schedulers]}, os.path.join(model_dir, "train_state_rank{}.pt".format(rank)))
+
+
+def load_train_state(model_dir, rank, checkpoint_step):
+  """The training state saved with the checkpoint of `checkpoint_step`, None if there is none"""
+  path = os.path.join(model_dir, "train_state_rank{}.pt".format(rank))
+  if not os.path.isfile(path):
+    return None
+  state = torch.load(path, map_location="cpu", weights_only=False)
+  if state["checkpoint_step"] != checkpoint_step:
+    logger.warning("{} belongs to step {}, not to checkpoint step {}; resuming at the epoch start".format(
+      path, state["checkpoint_step"], checkpoint_step))
+    return None
+  return state
+
+
+class PreemptionHandler():
+  """ Turns SIGTERM into a stop at the same step on every rank.
+
+  The signal only sets a flag. `should_stop` agrees on it with an allreduce over a
+  CPU (gloo) group, but only every `check_interval` steps and at the checkpoint steps
+  (`save_interval`); the other steps pay no collective. A stop therefore comes at most
+  `check_interval - 1` steps after the signal, which has to fit the grace period
+  before SIGKILL together with the checkpoint save.
+  """
+  def __init__(self, check_interval=10, save_interval=None):
+    self.requested = False
+    self.check_interval = check_interval
+    self.save_interval = save_interval
+    self.group = dist.new_group(backend="gloo")
+    signal.signal(signal.SIGTERM, self._handle)
+
+  @classmethod
+  def from_hparams(cls, hps):
+    return cls(getattr(hps.train, "preemption_check_interval", 10), hps.train.eval_interval)
+
+  def _handle(self, signum, frame):
+    self.requested = True
+
+  def should_stop(self, step):
+    """Whether every rank should stop after `step`; the same on all ranks, as they call it with the same steps"""
+    if step % self.check_interval and not (self.save_interval and step % self.save_interval == 0):
+      return False
+    flag = torch.tensor([int(self.requested)])
+    dist.all_reduce(flag, op=dist.ReduceOp.MAX, group=self.group)
+    return bool(flag.item())
 
 
 def summarize(writer, global_step, scalars={}, histograms={}, images={}, audios={}, audio_sampling_rate=22050):
@@ -67,6 +254,103 @@ def summarize(writer, global_step, scalars={}, histograms={}, images={}, audios=
     writer.add_audio(k, v, global_step, audio_sampling_rate)
 
 
+class SummaryWorker():
+  """ Writes TensorBoard summaries of `writer` from a background thread.
+
+  `summarize` takes CPU data only: scalars, spectrograms and alignments as numpy
+  arrays and audio as CPU tensors. It queues them and returns at once; the worker
+  renders the plots with matplotlib and writes the events. When `max_pending`
+  summaries are already waiting, new ones are dropped (and counted in `dropped`)
+  rather than stalling the training step.
+  """
+  _plot_lock = threading.Lock() # pyplot is not thread-safe and every writer has its own worker
+
+  def __init__(self, writer, max_pending=8):
+    self.writer = writer
+    self.queue = queue.Queue(maxsize=max_pending)
+    self.dropped = 0
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def summarize(self, global_step, scalars={}, spectrograms={}, alignments={}, audios={}, audio_sampling_rate=22050):
+    scalars = {k: v.item() if torch.is_tensor(v) else v for k, v in scalars.items()}
+    try:
+      self.queue.put_nowait((global_step, scalars, spectrograms, alignments, audios, audio_sampling_rate))
+    except queue.Full:
+      self.dropped += 1
+
+  def _run(self):
+    while True:
+      global_step, scalars, spectrograms, alignments, audios, audio_sampling_rate = self.queue.get()
+      try:
+        with self._plot_lock:
+          images = {k: plot_spectrogram_to_numpy(v) for k, v in spectrograms.items()}
+          images.update({k: plot_alignment_to_numpy(v) for k, v in alignments.items()})
+        summarize(self.writer, global_step, scalars=scalars, images=images, audios=audios,
+                  audio_sampling_rate=audio_sampling_rate)
+      except Exception:
+        logger.exception("Writing summaries of step {} failed".format(global_step))
+      finally:
+        self.queue.task_done()
+
+  def close(self):
+    """Waits until every queued summary is written"""
+    self.queue.join()
+    self.writer.flush()
+
+
+class StepTimer():
+  """ Accumulates the time spent in named phases of the training step.
+
+  `with timer("g_forward"):` brackets a phase; phases may nest (the nested time also
+  counts towards the outer phase) and repeat within a step. On CUDA the brackets are
+  events, so timing adds no synchronization until `pop`, which the caller runs once
+  per log interval. `add` records host-side durations such as the DataLoader wait.
+  A disabled timer (ranks that do not log) records nothing.
+  """
+  def __init__(self, device, enabled=True):
+    self.device = device
+    self.enabled = enabled
+    self._intervals = []
+    self._host = {}
+
+  def _now(self):
+    if self.device.type == "cuda":
+      event = torch.cuda.Event(enable_timing=True)
+      event.record()
+      return event
+    return time.perf_counter()
+
+  @contextlib.contextmanager
+  def __call__(self, name):
+    if not self.enabled:
+      yield
+      return
+    start = self._now()
+    yield
+    self._intervals.append((name, start, self._now()))
+
+  def add(self, name, seconds):
+    if self.enabled:
+      self._host[name] = self._host.get(name, 0.) + seconds
+
+  def pop(self):
+    """Seconds per phase since the last call"""
+    elapsed = self._host
+    if self._intervals and self.device.type == "cuda":
+      self._intervals[-1][2].synchronize()
+    for name, start, end in self._intervals:
+      seconds = end - start if isinstance(start, float) else start.elapsed_time(end) / 1000.
+      elapsed[name] = elapsed.get(name, 0.) + seconds
+    self._intervals, self._host = [], {}
+    return elapsed
+
+
+def append_jsonl(path, record):
+  with open(path, "a") as f:
+    f.write(json.dumps(record) + "\n")
+
+
 def latest_checkpoint_path(dir_path, regex="G_*.pth"):
   f_list = glob.glob(os.path.join(dir_path, regex))
   f_list.sort(key=lambda f: int("".join(filter(str.isdigit, f))))
@@ -142,12 +426,52 @@ def load_wav_to_torch(full_path):
   return torch.FloatTensor(data.astype(np.float32)), sampling_rate
 
 
+def load_wav_to_torch_int16(full_path):
+  """Memory-map a PCM-16 wav and return its samples as an int16 tensor (no float conversion)."""
+  sampling_rate, data = read(full_path, mmap=True)
+  if data.dtype != np.int16:
+    raise ValueError("{} holds {} samples, expected PCM-16".format(full_path, data.dtype))
+  return torch.from_numpy(np.array(data)), sampling_rate
+
+
 def load_filepaths_and_text(filename, split="|"):
   with open(filename, encoding='utf-8') as f:
     filepaths_and_text = [line.strip().split(split) for line in f]
   return filepaths_and_text
 
 
+def get_device_type(hps):
+  """`train.device` if set, otherwise cuda when available"""
+  return getattr(hps.train, "device", "cuda" if torch.cuda.is_available() else "cpu")
+
+
+def get_autocast_dtype(hps, device_type):
+  """Autocast dtype: bf16 with train.bf16_run (or fp16_run on CPU), fp16 with fp16_run on CUDA, else None"""
+  if getattr(hps.train, "bf16_run", False) or (hps.train.fp16_run and device_type == "cpu"):
+    return torch.bfloat16
+  if hps.train.fp16_run:
+    return torch.float16
+  return None
+
+
+def alignment_schedule(hps, epoch):
+  """(frozen, record) for `epoch` with train.freeze_alignment_epoch / train.realign_interval.
+
+  Before freeze_alignment_epoch MAS runs on every step and the last of those epochs records
+  its durations. From then on stored durations replace MAS (batches with an unknown item
+  still run MAS and record it), except every realign_interval-th epoch, which runs MAS on
+  every step and refreshes the store.
+  """
+  freeze_epoch = getattr(hps.train, "freeze_alignment_epoch", None)
+  if freeze_epoch is None:
+    return False, False
+  if epoch < freeze_epoch:
+    return False, epoch == freeze_epoch - 1
+  interval = getattr(hps.train, "realign_interval", None)
+  realign = bool(interval) and epoch > freeze_epoch and (epoch - freeze_epoch) % interval == 0
+  return not realign, True
+
+
 def get_hparams(init=True):
   parser = argparse.ArgumentParser()
   parser.add_argument('-c', '--config', type=str, default="./configs/base.json",
@@ -0,0 +1,189 @@
+import os
+import time
+import json
+import argparse
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.tensorboard import SummaryWriter
+
+import utils
+from data_utils import (
+  TextAudioLoader,
+  TextAudioCollate,
+  TextAudioSpeakerLoader,
+  TextAudioSpeakerCollate
+)
+from models import SynthesizerTrn
+from mel_processing import MelSpectrogram
+from stft_loss import MultiResolutionSTFTLoss
+from text.symbols import symbols
+
+
+def get_args():
+  parser = argparse.ArgumentParser(description="Full validation of the checkpoints of a training run")
+  parser.add_argument('-m', '--model', type=str, required=True,
+                      help='Model name (the folder under ./logs given to train_latest*.py)')
+  parser.add_argument('--device', type=str, default="cpu",
+                      help='Device to synthesize on (default: cpu, so no training GPU is used)')
+  parser.add_argument('--batch_size', type=int, default=16)
+  parser.add_argument('--watch', action='store_true',
+                      help='Keep evaluating every new G_*.pth until --parent_pid exits')
+  parser.add_argument('--parent_pid', type=int, default=None,
+                      help='With --watch: stop once this process has exited and its last checkpoint is evaluated')
+  parser.add_argument('--poll_interval', type=float, default=30.)
+  parser.add_argument('--nice', type=int, default=10,
+                      help='Scheduling priority increment, so training keeps the CPU')
+  parser.add_argument('--num_threads', type=int, default=None)
+  return parser.parse_args()
+
+
+def validation_loader(hps, batch_size):
+  """Length-sorted batches over the whole validation filelist"""
+  n_speakers = getattr(hps.data, "n_speakers", 0)
+  if n_speakers > 0:
+    dataset, collate_fn = TextAudioSpeakerLoader(hps.data.validation_files, hps.data), TextAudioSpeakerCollate()
+  else:
+    dataset, collate_fn = TextAudioLoader(hps.data.validation_files, hps.data), TextAudioCollate()
+  order = dataset.lengths.argsort()[::-1].tolist()
+  batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+  return DataLoader(dataset, num_workers=0, batch_sampler=batches, collate_fn=collate_fn)
+
+
+def evaluate(hps, net_g, loader, mel_fn, stft_fn, device):
+  """Synthesizes the whole validation set twice.
+
+  Batched `infer` (text, predicted durations) gives the RTF (synthesis time over
+  generated audio duration) and how far the predicted lengths are from the reference.
+  Its frames are not time-aligned with the reference, so the spectral distances are
+  taken on the posterior resynthesis (enc_q -> dec) instead: masked mel L1 over the
+  reference frames and the multi-resolution STFT distance (spectral convergence + log
+  magnitude) per utterance. Returns the metrics and the mel and audio of the first
+  (longest) utterance from `infer`.
+  """
+  net_g.eval()
+  torch.manual_seed(hps.train.seed) # same noise for every checkpoint
+  mel_abs, mel_count, stft_sum, n_utts, synth_sec, audio_sec = 0., 0, 0., 0, 0., 0.
+  frames_ref, frames_gen, length_error = 0, 0, 0.
+  sample = None
+  with torch.no_grad():
+    for x, x_lengths, spec, spec_lengths, y, y_lengths, *rest in loader:
+      x, x_lengths = x.to(device), x_lengths.to(device)
+      spec, spec_lengths = spec.to(device), spec_lengths.to(device)
+      y, y_lengths = y.to(device), y_lengths.to(device)
+      if y.dtype == torch.int16:
+        y = y.float() / hps.data.max_wav_value
+      sid = rest[0].to(device) if net_g.n_speakers > 0 else None
+
+      if device.type == "cuda":
+        torch.cuda.synchronize(device)
+      start = time.perf_counter()
+      y_hat, _, _, y_mask, *_ = net_g.infer(x, x_lengths, sid=sid, noise_scale=.667, noise_scale_w=0.8, length_scale=1)
+      if device.type == "cuda":
+        torch.cuda.synchronize(device)
+      synth_sec += time.perf_counter() - start
+      y_hat_frames = y_mask.sum([1, 2]).long()
+      y_hat_lengths = y_hat_frames * hps.data.hop_length
+      audio_sec += y_hat_lengths.sum().item() / hps.data.sampling_rate
+      frames_ref += spec_lengths.sum().item()
+      frames_gen += y_hat_frames.sum().item()
+      length_error += ((y_hat_frames - spec_lengths).abs() / spec_lengths).sum().item()
+
+      g = net_g.emb_g(sid).unsqueeze(-1) if net_g.n_speakers > 0 else None
+      z, _, _, spec_mask = net_g.enc_q(spec, spec_lengths, g=g)
+      y_resyn, _ = net_g.dec(z * spec_mask, g=g)
+      mel = mel_fn.spec_to_mel(spec)
+      y_resyn_mel = mel_fn(y_resyn.squeeze(1).float())[:, :, :mel.size(2)]
+      mel_abs += ((mel - y_resyn_mel).abs() * spec_mask).sum().item()
+      mel_count += spec_lengths.sum().item() * mel.size(1)
+
+      for i in range(x.size(0)):
+        n = min(y_lengths[i].item(), spec_lengths[i].item() * hps.data.hop_length)
+        sc_loss, mag_loss = stft_fn(y_resyn[i:i+1, 0, :n].float(), y[i:i+1, 0, :n])
+        stft_sum += (sc_loss + mag_loss).item()
+      n_utts += x.size(0)
+
+      if sample is None:
+        y_hat_mel = mel_fn(y_hat[:1].squeeze(1).float())
+        sample = {
+          "mel": y_hat_mel[0, :, :y_hat_frames[0]].cpu().numpy(),
+          "audio": y_hat[0, :, :y_hat_lengths[0]].float().cpu()}
+  net_g.train()
+  metrics = {
+    "val/resyn_mel_l1": mel_abs / mel_count,
+    "val/resyn_mrstft": stft_sum / n_utts,
+    "val/rtf": synth_sec / audio_sec,
+    "val/duration_ratio": frames_gen / frames_ref,
+    "val/duration_abs_error": length_error / n_utts,
+    "val/utterances": n_utts}
+  return metrics, sample
+
+
+def evaluated_steps(path):
+  steps = set()
+  if os.path.exists(path):
+    with open(path) as f:
+      steps = {json.loads(line)["step"] for line in f if line.strip()}
+  return steps
+
+
+def parent_alive(pid):
+  """True while process `pid` runs, always True without one"""
+  if pid is None:
+    return True
+  try:
+    os.kill(pid, 0)
+  except OSError:
+    return False
+  return True
+
+
+def main():
+  args = get_args()
+  if args.nice:
+    os.nice(args.nice)
+  if args.num_threads:
+    torch.set_num_threads(args.num_threads)
+  model_dir = os.path.join("./logs", args.model)
+  hps = utils.get_hparams_from_dir(model_dir)
+  logger = utils.get_logger(model_dir, filename="validate.log")
+  device = torch.device(args.device)
+
+  loader = validation_loader(hps, args.batch_size)
+  net_g = SynthesizerTrn(
+      len(symbols),
+      hps.data.filter_length // 2 + 1,
+      hps.train.segment_size // hps.data.hop_length,
+      n_speakers=getattr(hps.data, "n_speakers", 0),
+      **hps.model).to(device)
+  mel_fn = MelSpectrogram.from_hparams(hps.data).to(device)
+  stft_fn = MultiResolutionSTFTLoss().to(device)
+  writer = SummaryWriter(log_dir=os.path.join(model_dir, "eval"))
+  metrics_path = os.path.join(model_dir, "eval_metrics.jsonl")
+  done = evaluated_steps(metrics_path)
+
+  while True:
+    # checked before looking for checkpoints, so the final one is still evaluated after the parent exits
+    training = parent_alive(args.parent_pid)
+    step = utils.latest_checkpoint_step(model_dir)
+    if step is not None and step not in done:
+      try:
+        utils.load_checkpoint(os.path.join(model_dir, "G_{}.pth".format(step)), net_g)
+      except (FileNotFoundError, AssertionError): # removed by checkpoint rotation meanwhile
+        continue
+      metrics, sample = evaluate(hps, net_g, loader, mel_fn, stft_fn, device)
+      logger.info("Step {}: {}".format(step, metrics))
+      utils.summarize(writer, step, scalars=metrics,
+          images={"val/gen_mel": utils.plot_spectrogram_to_numpy(sample["mel"])},
+          audios={"val/gen_audio": sample["audio"]}, audio_sampling_rate=hps.data.sampling_rate)
+      writer.flush()
+      utils.append_jsonl(metrics_path, dict(step=step, **metrics))
+      done.add(step)
+    elif not (args.watch and training):
+      break
+    else:
+      time.sleep(args.poll_interval)
+  writer.close()
+
+
+if __name__ == "__main__":
+  main()